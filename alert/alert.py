@@ -5,21 +5,20 @@
 # Search for regression in a histogram dump directory produced by the
 # node exporter.
 
-import matplotlib.pyplot as plt
-
 import json
 import numpy
-import cv2
 import sys
+import errno
 import os
 import logging
 import json
-import pylab
 import os.path
 import argparse
-
-from time import mktime, strptime
-from datetime import datetime, timedelta
+import multiprocessing
+import functools
+import itertools
+import re
+import StringIO
 
 histograms = None
 args = None
@@ -27,10 +26,22 @@ args = None
 OUTPUT_PLOTS, PLOT_FILENAME = False, "plot-{histogram_name}-{date}.png" # Whether to plot the found regressions, and what filename to save them with if plotting
 REGRESSION_FILENAME = "dashboard/regressions.json"               # Path of JSON file containing a list of all found regressions
 HISTOGRAM_DB = "Histograms.json"                                 # Path to JSON file containing histogram definitions map
+HISTOGRAMS_DIR = "./histograms"                                  # Path of the directory containing the histogram evolutions exported by the node exporter
+SERIES_CACHE_DIR = "series_cache"                                # Path of the directory to cache parsed histogram evolutions in
+SERIES_CACHE_VERSION = 2                                         # Version of the series cache format, entries written with a different version are ignored
+JSON_CHUNK_SIZE = 1 << 16                                        # Number of bytes to read at a time when parsing exported histogram evolutions
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")                      # Whitespace allowed between JSON tokens
+JSON_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")                  # Text at the end of a buffer that might be the rest of a JSON number
+CHECKPOINT_DIR = "checkpoints"                                   # Path of the directory to store incremental detection checkpoints in
+FLT_EPSILON = numpy.finfo('float32').eps                         # Smallest histogram weight product that OpenCV will rescale Bhattacharyya coefficients by
 
 def has_not_enough_data(hist):
     return numpy.sum(hist) < 1000 or numpy.max(hist) < 1000
 
+def has_enough_data_series(counts):
+    """Returns a boolean array that is `True` for each row of the 2D array `counts` that has enough data to be compared (the row-wise opposite of `has_not_enough_data`)"""
+    return (numpy.sum(counts, axis=1) >= 1000) & (numpy.max(counts, axis=1) >= 1000)
+
 def normalize(hist):
     """Returns a copy of the given histogram scaled such that its sum is 1, or 0 if this is not possible"""
     hist = hist.astype('float32')
@@ -38,128 +49,439 @@ def normalize(hist):
     if total == 0: return hist
     return hist / total
 
+def normalize_series(counts):
+    """Returns a copy of the 2D array `counts` with each row scaled such that its sum is 1, or 0 if this is not possible (the row-wise equivalent of `normalize`)"""
+    counts = counts.astype('float32')
+    totals = numpy.sum(counts, axis=1, keepdims=True)
+    totals[totals == 0] = 1 # rows that sum to 0 stay all zeros
+    return counts / totals
+
 def bat_distance(hist, ref):
+    """Compute the Bhattacharyya distance between two distributions, the same way as OpenCV's `cv2.compareHist(hist, ref, 3)`"""
+    return bat_distances(hist.astype('float64')[numpy.newaxis], ref.astype('float64')[numpy.newaxis])[0]
+
+def bat_distance_opencv(hist, ref):
     """Compute the Bhattacharyya distance between two distributions, using OpenCV"""
+    import cv2 # OpenCV is only an optional dependency, and takes a while to import
     return cv2.compareHist(hist, ref, 3)
 
-def compare_range(series, idx, range, nr_ref_days):
-    """Compare histogram at index `idx` to all of the histograms at indices in `range` in `series`."""
-    assert iter(series) and all(len(item) == 2 for item in series), "`series` must be of the form `[(DATETIME_1, HISTOGRAM_1), ..., (DATETIME_N, HISTOGRAM_N)]`"
-    assert 0 <= idx < len(series) and idx % 1 == 0, "`index` must be a valid index"
-    assert iter(range) and all(0 <= i < len(series) and i % 1 == 0 for i in range), "`range` must be an iterable of valid indices"
-    dt, hist = series[idx]
-    hist = normalize(hist)
-    distances = []
-    logging.debug("Comparing " + dt.strftime("%d/%m/%Y"))
-
-    for jdx in range:
-        ref_dt, ref_hist = series[jdx]
-        logging.debug("To " + ref_dt.strftime("%d/%m/%Y"))
-
-        if has_not_enough_data(ref_hist):
-            logging.debug("Reference histogram has not enough data")
-            ref_hist = normalize(ref_hist)
-            continue
-        ref_hist = normalize(ref_hist)
-
-        distances.append(bat_distance(hist, ref_hist))
-
-    # There are histograms that have enough data to be compared
-    if len(distances):
-        logging.debug('Bhattacharyya distance: ' + str(distances[-1]))
-        logging.debug('Standard deviation of the distances: ' + str(numpy.std(distances)))
-
-    # The last compared histograms are significantly different, and the differences have a very narrow spread
-    if len(distances) > nr_ref_days/2 and distances[-1] > 0.12 and numpy.std(distances) <= 0.01:
-        logging.debug("Suspicious difference found")
-        return (hist, ref_hist) # Produce the last compared histogram pair
-    else:
-        logging.debug("No suspicious difference found")
-        return (None, None)
-
-def get_raw_histograms(comparisons):
-    hist = None
-    ref_hist = None
-
-    for h, r in comparisons:
-        if h is not None:
-            return (h, r)
+def bat_distances(hists, refs):
+    """Compute the Bhattacharyya distance between each row of the 2D array `hists` and the corresponding row of the 2D array `refs`, using the same formula as OpenCV's `cv2.compareHist(hist, ref, 3)`"""
+    coefficients = numpy.sum(numpy.sqrt(hists * refs), axis=1)
+    scales = numpy.sum(hists, axis=1) * numpy.sum(refs, axis=1)
+    scales[numpy.abs(scales) <= FLT_EPSILON] = 1 # OpenCV does not rescale the coefficient for empty histograms
+    return numpy.sqrt(numpy.maximum(1 - coefficients / numpy.sqrt(scales), 0))
+
+def chi_square_distances(hists, refs):
+    """Compute the symmetric chi-square distance between each row of the 2D array `hists` and the corresponding row of the 2D array `refs`, scaled to be between 0 and 1 for normalized histograms"""
+    sums = hists + refs
+    nonzero = sums > 0
+    return 0.5 * numpy.sum(numpy.where(nonzero, (hists - refs) ** 2 / numpy.where(nonzero, sums, 1), 0), axis=1)
+
+def ks_distances(cdfs, ref_cdfs):
+    """Compute the Kolmogorov-Smirnov statistic between each row of the 2D array of cumulative histograms `cdfs` and the corresponding row of the 2D array of cumulative histograms `ref_cdfs`"""
+    return numpy.max(numpy.abs(cdfs - ref_cdfs), axis=1)
+
+def emd_distances(cdfs, ref_cdfs):
+    """Compute the earth mover's distance between each row of the 2D array of cumulative histograms `cdfs` and the corresponding row of the 2D array of cumulative histograms `ref_cdfs`, with the buckets placed evenly between 0 and 1"""
+    bucket_count = cdfs.shape[1]
+    if bucket_count < 2: return numpy.zeros(len(cdfs))
+    return numpy.sum(numpy.abs(cdfs[:, :-1] - ref_cdfs[:, :-1]), axis=1) / (bucket_count - 1)
+
+def window_pairs(size, window):
+    """Returns the index arrays `(rows, cols)` of every pair of entries in a series of length `size` that are between 1 and `window` entries apart, with `rows[k] > cols[k]`."""
+    rows, cols = numpy.tril_indices(size, -1)
+    in_window = rows - cols <= window
+    return rows[in_window], cols[in_window]
+
+def window_distance_matrix(values, window, distances):
+    """Compute `distances(hists, refs)` for every pair of rows of the 2D array `values` that are at most `window` rows apart, in one batch.
+
+Returns a symmetric `len(values)` by `len(values)` matrix of distances, with NaN for pairs of rows that are further apart than `window`."""
+    size = len(values)
+    rows, cols = window_pairs(size, window)
+    result = numpy.empty((size, size))
+    result.fill(numpy.nan)
+    result[rows, cols] = result[cols, rows] = distances(values[rows], values[cols])
+    return result
+
+def bat_distance_matrix(normalized, window):
+    """Compute the Bhattacharyya distance between every pair of rows of the 2D array `normalized` that are at most `window` rows apart (see `window_distance_matrix`).
+
+The distances are computed the same way as `cv2.compareHist(hist, ref, 3)`, so `bat_distance_matrix(normalized, window)[i, j] == bat_distance(normalized[i], normalized[j])` up to rounding."""
+    return window_distance_matrix(normalized.astype('float64'), window, bat_distances)
+
+def bat_distance_matrix_opencv(normalized, window):
+    """Same as `bat_distance_matrix`, but computes each of the distances separately using OpenCV."""
+    size = len(normalized)
+    result = numpy.empty((size, size))
+    result.fill(numpy.nan)
+    for row, col in zip(*window_pairs(size, window)):
+        result[row, col] = result[col, row] = bat_distance_opencv(normalized[row], normalized[col])
+    return result
+
+def chi_square_distance_matrix(normalized, window):
+    """Compute the symmetric chi-square distance between every pair of rows of the 2D array `normalized` that are at most `window` rows apart (see `window_distance_matrix`)."""
+    return window_distance_matrix(normalized.astype('float64'), window, chi_square_distances)
+
+def ks_distance_matrix(normalized, window):
+    """Compute the Kolmogorov-Smirnov statistic between every pair of rows of the 2D array `normalized` that are at most `window` rows apart (see `window_distance_matrix`)."""
+    return window_distance_matrix(numpy.cumsum(normalized, axis=1, dtype='float64'), window, ks_distances)
+
+def emd_distance_matrix(normalized, window):
+    """Compute the earth mover's distance between every pair of rows of the 2D array `normalized` that are at most `window` rows apart (see `window_distance_matrix`)."""
+    return window_distance_matrix(numpy.cumsum(normalized, axis=1, dtype='float64'), window, emd_distances)
+
+# Distance metrics that histograms can be compared with, by name. Each entry is a tuple of the form
+# `(DISTANCE_MATRIX_FUNCTION, DEFAULT_THRESHOLD, DEFAULT_MAX_STD)`: a regression is suspected when the last distance is above `DEFAULT_THRESHOLD`,
+# while the standard deviation of the distances is at most `DEFAULT_MAX_STD`. The defaults for the metrics other than the Bhattacharyya
+# distance are derived from its defaults, and are only starting points for tuning.
+DISTANCE_METRICS = {
+    "bhattacharyya":        (bat_distance_matrix, 0.12, 0.01),
+    "hellinger":            (bat_distance_matrix, 0.12, 0.01), # the Bhattacharyya distance as computed by OpenCV is the Hellinger distance
+    "bhattacharyya-opencv": (bat_distance_matrix_opencv, 0.12, 0.01),
+    "chi-square":           (chi_square_distance_matrix, 0.02, 0.002),
+    "ks":                   (ks_distance_matrix, 0.1, 0.01),
+    "emd":                  (emd_distance_matrix, 0.02, 0.002),
+}
+
+def metric_criteria(metric, threshold = None, max_std = None):
+    """Returns the pair `(THRESHOLD, MAX_STD)` of criteria for suspicious differences to use with the distance metric `metric`, taking the metric's defaults for any of `threshold` and `max_std` that are `None`."""
+    distance_function, default_threshold, default_max_std = DISTANCE_METRICS[metric]
+    return default_threshold if threshold is None else threshold, default_max_std if max_std is None else max_std
+
+def prepare_series(series, window, metric = "bhattacharyya"):
+    """Normalize the series `series` (see `compare_histogram`) and compute the distances between all of its histograms that are at most `window` entries apart using the distance metric `metric`, returning a tuple `(NORMALIZED, ENOUGH_DATA, DISTANCE_MATRIX)`.
+
+The result can be used to look for regressions using any comparison window that fits into `window` (see `find_regressions`)."""
+    dates, counts = series
+    normalized = normalize_series(counts)
+    enough_data = has_enough_data_series(counts)
+    distance_function = DISTANCE_METRICS[metric][0]
+    return normalized, enough_data, distance_function(normalized, window)
+
+def find_regressions(enough_data, distance_matrix, nr_ref_days, nr_future_days, threshold, max_std, min_references = None):
+    """Returns a boolean array that is `True` for each entry of a series that is the start of a regression, given the entries of the series that have enough data `enough_data` and the distances between them `distance_matrix` (see `prepare_series`).
+
+Each of the `nr_future_days + 1` entries starting at an entry with enough data is compared to the `nr_ref_days` entries before that entry, skipping references that don't have enough data. Each of those comparisons is suspicious if there are at least `min_references` references (more than half of `nr_ref_days` by default), the distance to the last of them is above `threshold`, and the standard deviation of the distances to all of them is at most `max_std`. The entry is the start of a regression if all of the comparisons are suspicious."""
+    if min_references is None: min_references = nr_ref_days / 2 + 1
+    size = len(enough_data)
+    analyzed = numpy.arange(max(size - nr_future_days, 0)) # the last `nr_future_days` entries don't have enough entries after them to be analyzed
+    if not len(analyzed) or nr_ref_days == 0:
+        return numpy.zeros(size, dtype=bool)
+
+    # all of the comparisons are done at once, with axes (ANALYZED_ENTRY, COMPARED_ENTRY, REFERENCE)
+    compared = analyzed[:, numpy.newaxis, numpy.newaxis] + numpy.arange(nr_future_days + 1)[numpy.newaxis, :, numpy.newaxis]
+    references = analyzed[:, numpy.newaxis, numpy.newaxis] - nr_ref_days + numpy.arange(nr_ref_days)[numpy.newaxis, numpy.newaxis, :]
+    valid = (references >= 0) & enough_data[numpy.maximum(references, 0)]
+    distances = numpy.where(valid, distance_matrix[compared, numpy.maximum(references, 0)], 0)
+
+    # the last valid distance, and the standard deviation of the valid distances, for each comparison
+    reference_count = numpy.sum(valid, axis=2)
+    last_reference = nr_ref_days - 1 - numpy.argmax(valid[:, :, ::-1], axis=2)
+    last_distances = distances[numpy.arange(len(analyzed))[:, numpy.newaxis], numpy.arange(nr_future_days + 1)[numpy.newaxis, :], last_reference]
+    with numpy.errstate(invalid="ignore", divide="ignore"): # comparisons without any valid references are not suspicious anyway
+        means = numpy.sum(distances, axis=2) / reference_count
+        deviations = numpy.where(valid, distances - means[:, :, numpy.newaxis], 0)
+        stds = numpy.sqrt(numpy.sum(deviations * deviations, axis=2) / reference_count)
+        suspicious = (reference_count > 0) & (reference_count >= min_references) & (last_distances > threshold) & (stds <= max_std)
+
+    regressions = numpy.zeros(size, dtype=bool)
+    regressions[analyzed] = enough_data[analyzed] & numpy.all(suspicious, axis=1)
+    return regressions
 
-    assert(False)
+def compare_histogram(series, histogram, buckets, nr_ref_days = 7, nr_future_days = 2, since = None, metric = "bhattacharyya", threshold = None, max_std = None, min_references = None):
+    """Compare the past `nr_future_days` days worth of histograms in `series` to the past `nr_ref_days` days worth of histograms in `series`, returning a list of found regressions.
 
-def compare_histogram(series, histogram, buckets, nr_ref_days = 7, nr_future_days = 2):
-    """Compare the past `nr_future_days` days worth of histograms in `series` to the past `nr_ref_days` days worth of histograms in `series`, returning a list of found regressions."""
+`series` is a pair `(DATES, COUNTS)`, where `DATES` is a sorted `datetime64[D]` array and `COUNTS` is a 2D array with the histogram for each of those dates as its rows (see `load_series`). If `since` is a date, only the histograms for dates after it are analyzed, though earlier histograms are still used as references. `metric` is the name of the distance metric to compare histograms with (see `DISTANCE_METRICS`), and `threshold`, `max_std` and `min_references` override its criteria for suspicious differences (see `find_regressions`)."""
     regressions = []
-    series_items = sorted(series.items(), key=lambda x: x[0]) # sorted list of pairs, each of the form (DATETIME, HISTOGRAM_FOR_THAT_DATE)
-
-    for i, entry in enumerate(series_items[:-nr_future_days if nr_future_days else None]):
-        dt, hist = entry
-
-        logging.debug("======================")
-        logging.debug("Analyzing " + dt.strftime("%d/%m/%Y"))
-
-        if has_not_enough_data(hist): # Histogram doesn't have enough submissions to get a meaningful result
-            logging.debug("Histogram has not enough data")
+    dates, counts = series
+    if not len(dates):
+        return regressions
+
+    # normalize the whole series and compute all of the distances that the comparisons will need up front
+    threshold, max_std = metric_criteria(metric, threshold, max_std)
+    normalized, enough_data, distance_matrix = prepare_series(series, nr_ref_days + nr_future_days, metric)
+    found = find_regressions(enough_data, distance_matrix, nr_ref_days, nr_future_days, threshold, max_std, min_references)
+
+    for i in numpy.flatnonzero(found):
+        dt = dates[i].tolist()
+        if since is not None and dt <= since: # Histogram was already analyzed in a previous run
             continue
 
-        comparisons = []
-        ref_range = range(max(i - nr_ref_days, 0), i)
-
-        for j in range(i, min(i + nr_future_days + 1, len(series_items))):
-            comparisons.append(compare_range(series_items, j, ref_range, nr_ref_days))
-
-        if len(comparisons) == sum(map(lambda x: x != (None, None), comparisons)):
-            logging.debug('Regression found for '+ histogram + dt.strftime(", %d/%m/%Y"))
-            regressions.append((dt, histogram, buckets, get_raw_histograms(comparisons)))
-            if OUTPUT_PLOTS and len(buckets) < 300: # There are histograms with several hundred buckets that cause plotting to fail since the resulting image is just too large
-                file_name = PLOT_FILENAME.format(histogram_name=histogram, date=dt.strftime("%d-%m-%Y"))
-                plot(file_name, histogram, buckets, get_raw_histograms(comparisons))
+        logging.debug('Regression found for '+ histogram + dt.strftime(", %d/%m/%Y"))
+        raw_histograms = (normalized[i], normalized[i - 1]) # the regressed histogram, and the last histogram it was compared to
+        regressions.append((dt, histogram, buckets, raw_histograms))
+        if OUTPUT_PLOTS and len(buckets) < 300: # There are histograms with several hundred buckets that cause plotting to fail since the resulting image is just too large
+            file_name = PLOT_FILENAME.format(histogram_name=histogram, date=dt.strftime("%d-%m-%Y"))
+            plot(file_name, histogram, buckets, raw_histograms)
     return regressions
 
-def process_file(filename):
-    logging.debug("Processing " + filename)
-    series = {}
+def iter_json_array(f, chunk_size = JSON_CHUNK_SIZE):
+    """Iterate over the elements of the JSON array in the file `f`, reading `chunk_size` bytes at a time.
+
+Unlike `json.load`, only the elements that are currently being decoded have to be held in memory, rather than the whole text of the file and all of its decoded elements."""
+    decoder = json.JSONDecoder()
+    buffer, position, done = "", 0, False
+    state = "start" # "start" expects "[", "first" expects an element or "]", "element" expects an element, "separator" expects "," or "]"
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position == len(buffer): # the buffer needs more data before anything else can be decoded
+            if done:
+                raise ValueError("Unexpected end of JSON array")
+            chunk = f.read(chunk_size)
+            buffer, position, done = buffer[position:] + chunk, 0, not chunk
+            continue
+
+        if state == "start":
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array")
+            position, state = position + 1, "first"
+        elif state in {"first", "separator"} and buffer[position] == "]":
+            return
+        elif state == "separator":
+            if buffer[position] != ",":
+                raise ValueError("Expected ',' or ']' in JSON array")
+            position, state = position + 1, "element"
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+            if end is None or (not done and JSON_NUMBER_TAIL.match(buffer, end)): # the element might continue in the next chunk (numbers that are cut off at the end of the buffer still decode)
+                if done:
+                    raise ValueError("Invalid element in JSON array")
+                chunk = f.read(chunk_size)
+                buffer, position, done = buffer[position:] + chunk, 0, not chunk
+                continue
+            yield element
+            position, state = end, "separator"
+
+class SeriesBuilder:
+    """Accumulates the histograms of a series into a 2D array with one row of counts per date, which grows as new dates are added."""
+    def __init__(self, bucket_count, capacity = 64):
+        self.bucket_count = bucket_count
+        self.counts = numpy.zeros((capacity, bucket_count))
+        self.rows = {} # mapping from dates to their rows in `self.counts`, in the order that they were added
+        self.dates = []
+        self.is_sorted = True
+
+    def __contains__(self, date):
+        return date in self.rows
+
+    def row(self, date):
+        """Returns the row of counts for the date `date`, a string of the form `YYYY-MM-DD`, adding an empty one if there is no row for it yet."""
+        try:
+            return self.counts[self.rows[date]]
+        except KeyError:
+            index = len(self.dates)
+            if index == len(self.counts): # out of space, double the capacity
+                counts = numpy.zeros((2 * len(self.counts), self.bucket_count))
+                counts[:index] = self.counts
+                self.counts = counts
+            if self.dates and date < self.dates[-1]:
+                self.is_sorted = False
+            self.rows[date] = index
+            self.dates.append(date)
+            return self.counts[index]
+
+    def build(self):
+        """Returns the accumulated series as a pair `(DATES, COUNTS)` (see `load_series`), sorted by date."""
+        dates = numpy.array(self.dates, dtype="datetime64[D]")
+        counts = self.counts[:len(self.dates)]
+        if not self.is_sorted: # dates are usually added in order, so sorting can mostly be avoided
+            order = numpy.argsort(dates, kind="mergesort")
+            dates, counts = dates[order], counts[order]
+        return dates, counts
+
+def parse_series(filename):
+    """Parse one of the JSON files of the form `histograms/MEASURE_NAME.json`, returning a tuple `(DATES, COUNTS, BUCKETS)` (see `load_series`), or `None` if the histograms in it can't be compared with each other."""
+    measure_name, _ = os.path.splitext(os.path.basename(filename)) # the measure name is the filename without the extension
+    builder = None
     buckets = []
 
-    regressions = []
     with open(filename) as f: # one of the JSON files of the form `histograms/MEASURE_NAME.json`
-        measures = json.load(f)
-        for measure in measures: # a measure in this context is a histogram and a date that the histogram applies to
+        for measure in iter_json_array(f): # a measure in this context is a histogram and a date that the histogram applies to
             # determine the date of the entry
             assert "date" in measure, "Missing date in measure"
-            conv = strptime(measure['date'][:10], "%Y-%m-%d")
-            measure_date = datetime.fromtimestamp(mktime(conv))
-
-            # add the histogram values to the corresponding entry in the time series
-            if measure_date in series:
-                if series[measure_date].shape != numpy.array(measure["values"]).shape:
-                    print "Shape mismatch in {}: {} cannot be added to {}".format(filename, series[measure_date], measure["values"])
+            measure_date = measure['date'][:10]
+            values = measure["values"]
+            if builder is None:
+                builder = SeriesBuilder(len(values))
+
+            # check that the histogram can be added to the series
+            if len(values) != builder.bucket_count:
+                if measure_date in builder:
+                    print "Shape mismatch in {}: {} cannot be added to {}".format(filename, builder.row(measure_date), values)
                     continue
-                series[measure_date] += numpy.array(measure["values"])
-            else:
-                series[measure_date] = numpy.array(measure["values"])
-            buckets = measure['buckets']
-
-        measure_name, _ = os.path.splitext(os.path.basename(filename)) # the measure name is the filename without the extension
-
-    if series:
-        # check that the series is valid
-        reference_date, expected_bucket_count = None, None
-        for date, histogram in series.items():
-            if expected_bucket_count is None:
-                reference_date, expected_bucket_count = date, len(histogram)
-            elif len(histogram) != expected_bucket_count:
                 logging.warn(
                     "BUCKET COUNT MISMATCH - IGNORING HISTOGRAM {} ({} has {} buckets, while {} has {} buckets)".format(
-                        measure_name, reference_date, expected_bucket_count, date, len(histogram)
+                        measure_name, builder.dates[0], builder.bucket_count, measure_date, len(values)
                     )
                 )
-                return []
+                return None
+
+            # add the histogram values to the corresponding entry in the time series
+            histogram = builder.row(measure_date)
+            histogram += values
+            buckets = measure['buckets']
 
-    regressions += compare_histogram(series, measure_name, buckets)
+    if builder is None:
+        return numpy.array([], dtype="datetime64[D]"), numpy.zeros((0, 0)), buckets
+    dates, counts = builder.build()
+    return dates, counts, buckets
+
+def series_cache_path(filename, cache_dir):
+    """Returns the path of the directory under `cache_dir` that holds the cached series for the exported histogram file `filename`."""
+    measure_name, _ = os.path.splitext(os.path.basename(filename))
+    return os.path.join(cache_dir, measure_name)
+
+def source_stamp(filename):
+    """Returns a JSON-serializable value that changes whenever the file `filename` does."""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "version": SERIES_CACHE_VERSION}
+
+def read_series_cache(filename, cache_dir):
+    """Returns the cached `(DATES, COUNTS, BUCKETS)` series for the exported histogram file `filename`, with `DATES` and `COUNTS` memory-mapped read-only from the cache, or `None` if there is no up-to-date cache entry for that file."""
+    path = series_cache_path(filename, cache_dir)
+    try:
+        with open(os.path.join(path, "source.json")) as f:
+            if json.load(f) != source_stamp(filename): # the exported file changed since the cache entry was written
+                return None
+        dates = numpy.load(os.path.join(path, "dates.npy"), mmap_mode="r")
+        counts = numpy.load(os.path.join(path, "counts.npy"), mmap_mode="r")
+        buckets = numpy.load(os.path.join(path, "buckets.npy")).tolist()
+    except (IOError, ValueError):
+        return None
+    return dates, counts, buckets
+
+def write_series_cache(filename, cache_dir, dates, counts, buckets):
+    """Store the series `(dates, counts, buckets)` parsed from the exported histogram file `filename` in the cache under `cache_dir`."""
+    path = series_cache_path(filename, cache_dir)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # the source stamp is written last, so an interrupted write leaves an entry that is never considered up to date
+    stamp_path = os.path.join(path, "source.json")
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    numpy.save(os.path.join(path, "dates.npy"), dates)
+    numpy.save(os.path.join(path, "counts.npy"), counts)
+    numpy.save(os.path.join(path, "buckets.npy"), numpy.array(buckets))
+    with open(stamp_path, "w") as f:
+        json.dump(source_stamp(filename), f)
+
+def load_series(filename, cache_dir = SERIES_CACHE_DIR):
+    """Load the series of histograms from the exported histogram file `filename`, returning a tuple `(DATES, COUNTS, BUCKETS)`, or `None` if the histograms in it can't be compared with each other.
+
+`DATES` is a sorted `datetime64[D]` array of the dates in the series, `COUNTS` is a 2D array containing the summed histogram for each of those dates as its rows, and `BUCKETS` is the list of bucket start values shared by all of the histograms.
+
+If `cache_dir` is not `None`, series are cached there in binary form, and are loaded as memory-mapped arrays rather than being parsed again until `filename` changes."""
+    if cache_dir is None:
+        return parse_series(filename)
+
+    series = read_series_cache(filename, cache_dir)
+    if series is None:
+        series = parse_series(filename)
+        if series is not None and len(series[0]) > 0:
+            write_series_cache(filename, cache_dir, *series)
+    return series
+
+def checkpoint_path(measure_name, checkpoint_dir):
+    """Returns the path of the detection checkpoint for the measure `measure_name` under `checkpoint_dir`."""
+    return os.path.join(checkpoint_dir, measure_name + ".npz")
+
+def read_checkpoint(measure_name, checkpoint_dir, bucket_count, nr_ref_days, nr_future_days):
+    """Returns the detection checkpoint `(LAST_ANALYZED, DATES, COUNTS)` stored for the measure `measure_name` (see `write_checkpoint`), or `None` if there is no checkpoint that is usable with the given bucket count and window sizes."""
+    try:
+        with numpy.load(checkpoint_path(measure_name, checkpoint_dir)) as checkpoint:
+            if checkpoint["counts"].shape[1] != bucket_count or checkpoint["nr_ref_days"] != nr_ref_days or checkpoint["nr_future_days"] != nr_future_days:
+                return None
+            return checkpoint["last_analyzed"], checkpoint["dates"], checkpoint["counts"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+def write_checkpoint(measure_name, checkpoint_dir, checkpoint, nr_ref_days, nr_future_days):
+    """Store the detection checkpoint `checkpoint` (see `make_checkpoint`) for the measure `measure_name` under `checkpoint_dir`."""
+    try:
+        os.makedirs(checkpoint_dir)
+    except OSError as e: # the directory already exists, possibly created by another worker process in the meantime
+        if e.errno != errno.EEXIST: raise
+    path = checkpoint_path(measure_name, checkpoint_dir)
+    temporary_path = path + ".tmp.npz" # written separately and moved into place, so an interrupted write doesn't leave a broken checkpoint behind
+    last_analyzed, dates, counts = checkpoint
+    numpy.savez(
+        temporary_path, last_analyzed=last_analyzed, dates=dates, counts=counts,
+        nr_ref_days=nr_ref_days, nr_future_days=nr_future_days
+    )
+    os.rename(temporary_path, path)
+
+def make_checkpoint(series, nr_ref_days, nr_future_days):
+    """Returns the detection checkpoint `(LAST_ANALYZED, DATES, COUNTS)` for after `series` was analyzed, or `None` if no date of `series` could be analyzed.
+
+The checkpoint contains the last analyzed date, as well as the last `nr_ref_days + nr_future_days` histograms of the series, which are all that the analysis of the following dates needs from the current series."""
+    dates, counts = series
+    if len(dates) <= nr_future_days:
+        return None
+    window_size = nr_ref_days + nr_future_days
+    return dates[-nr_future_days - 1], numpy.array(dates[-window_size:]), numpy.array(counts[-window_size:])
+
+def resume_series(series, checkpoint, nr_ref_days):
+    """Returns the part of `series` that is needed to analyze the dates after the last date analyzed in `checkpoint` (see `read_checkpoint`).
+
+Histograms for dates that are no longer in `series` are taken from the checkpoint instead."""
+    dates, counts = series
+    last_analyzed, checkpoint_dates, checkpoint_counts = checkpoint
+
+    # keep the new dates and the `nr_ref_days` dates before them that they are compared to
+    first = max(numpy.searchsorted(dates, last_analyzed, side="right") - nr_ref_days, 0)
+    dates, counts = dates[first:], counts[first:]
+    if first == 0: # the series might not reach back far enough anymore, fill in the missing reference dates from the checkpoint
+        missing = checkpoint_dates < dates[0] if len(dates) else numpy.ones(len(checkpoint_dates), dtype=bool)
+        if missing.any():
+            dates = numpy.concatenate((checkpoint_dates[missing], dates))
+            counts = numpy.concatenate((checkpoint_counts[missing], counts))
+    return dates, counts
+
+def compare_since_checkpoint(series, checkpoint, histogram, buckets, nr_ref_days = 7, nr_future_days = 2, **options):
+    """Compare the histograms in `series` for the dates after the last date analyzed in the detection checkpoint `checkpoint` (see `make_checkpoint`), or all of them if `checkpoint` is `None`.
+
+Returns a pair `(REGRESSIONS, CHECKPOINT)` with the regressions found (see `compare_histogram`, which any other keyword arguments are passed on to), and the checkpoint to continue from the next time."""
+    since = None
+    if checkpoint is not None:
+        series = resume_series(series, checkpoint, nr_ref_days)
+        since = checkpoint[0].tolist()
+        if not len(series[0]) or series[0][-1] <= checkpoint[0]: # there are no new dates
+            return [], checkpoint
+    regressions = compare_histogram(series, histogram, buckets, nr_ref_days, nr_future_days, since, **options)
+    return regressions, make_checkpoint(series, nr_ref_days, nr_future_days) or checkpoint
+
+def process_file(filename, cache_dir = SERIES_CACHE_DIR, checkpoint_dir = None, nr_ref_days = 7, nr_future_days = 2, metric = "bhattacharyya", threshold = None, max_std = None, min_references = None):
+    """Detect regressions in the exported histogram file `filename` (see `compare_histogram` for the detection parameters).
+
+If `checkpoint_dir` is not `None`, the detection is incremental: only the dates after the last date analyzed in a previous run are analyzed, and a checkpoint for the next run is stored in `checkpoint_dir`."""
+    logging.debug("Processing " + filename)
+    measure_name, _ = os.path.splitext(os.path.basename(filename)) # the measure name is the filename without the extension
+
+    series = load_series(filename, cache_dir)
+    if series is None:
+        return []
+
+    dates, counts, buckets = series
+    if checkpoint_dir is None:
+        return compare_histogram((dates, counts), measure_name, buckets, nr_ref_days, nr_future_days, None, metric, threshold, max_std, min_references)
+
+    checkpoint = read_checkpoint(measure_name, checkpoint_dir, counts.shape[1], nr_ref_days, nr_future_days)
+    regressions, new_checkpoint = compare_since_checkpoint(
+        (dates, counts), checkpoint, measure_name, buckets, nr_ref_days, nr_future_days,
+        metric=metric, threshold=threshold, max_std=max_std, min_references=min_references
+    )
+    if new_checkpoint is not None and new_checkpoint is not checkpoint:
+        write_checkpoint(measure_name, checkpoint_dir, new_checkpoint, nr_ref_days, nr_future_days)
     return regressions
 
 def plot(file_name, histogram_name, buckets, raw_histograms):
+    import pylab # plotting is rarely enabled, and importing matplotlib takes a while
     hist, ref_hist = raw_histograms
 
     fig = pylab.figure(figsize=(len(buckets)/3, 10))
@@ -177,7 +499,86 @@ def plot(file_name, histogram_name, buckets, raw_histograms):
     pylab.savefig(file_name, bbox_inches='tight')
     pylab.close(fig)
 
+def find_histogram_files(directory):
+    """Returns the paths of all of the exported histogram evolution files under `directory`, in a deterministic (sorted) order."""
+    filenames = []
+    for subdir, dirs, files in os.walk(directory):
+        for file in files:
+            if file.endswith(".json"):
+                filenames.append(subdir + "/" + file)
+    return sorted(filenames)
+
+def sweep_file(filename, grid, cache_dir = SERIES_CACHE_DIR, metric = "bhattacharyya"):
+    """Count the regressions in the exported histogram file `filename` for each of the detection parameter combinations in `grid`, a list of tuples of the form `(NR_REF_DAYS, NR_FUTURE_DAYS, THRESHOLD, MAX_STD, MIN_REFERENCES)` (see `find_regressions`).
+
+The distances between the histograms are only computed once, for the largest comparison window in `grid`, and every combination is evaluated against them."""
+    series = load_series(filename, cache_dir)
+    if series is None or not len(series[0]):
+        return [0] * len(grid)
+
+    dates, counts, buckets = series
+    window = max(nr_ref_days + nr_future_days for nr_ref_days, nr_future_days, threshold, max_std, min_references in grid)
+    normalized, enough_data, distance_matrix = prepare_series((dates, counts), window, metric)
+    return [int(numpy.sum(find_regressions(enough_data, distance_matrix, *parameters))) for parameters in grid]
+
+def map_files(function, filenames, jobs = 1):
+    """Yields `function(filename)` for each of the files in `filenames`, in the order of `filenames`, spreading the calls over `jobs` worker processes."""
+    if jobs <= 1:
+        for filename in filenames:
+            yield function(filename)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # the files are independent, so they can be processed in any order; `imap` hands back their results in order as they become available
+        for result in pool.imap(function, filenames, chunksize=4):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def detect_regressions(filenames, jobs = 1, **options):
+    """Process each of the files in `filenames` using `jobs` worker processes, returning all of the regressions found, grouped by file in the order of `filenames`.
+
+Any other keyword arguments are passed on to `process_file`."""
+    process = functools.partial(process_file, **options)
+    return [regression for file_regressions in map_files(process, filenames, jobs) for regression in file_regressions]
+
+def sweep_regressions(filenames, grid, jobs = 1, **options):
+    """Count the regressions in the files in `filenames` for each of the detection parameter combinations in `grid` (see `sweep_file`) using `jobs` worker processes, returning a list of pairs `(REGRESSION_COUNT, HISTOGRAM_COUNT)` with the number of regressions found for each combination, and the number of histograms they were found in.
+
+Any other keyword arguments are passed on to `sweep_file`."""
+    totals = [[0, 0] for parameters in grid]
+    for file_counts in map_files(functools.partial(sweep_file, grid=grid, **options), filenames, jobs):
+        for total, count in zip(totals, file_counts):
+            total[0] += count
+            total[1] += count > 0
+    return [tuple(total) for total in totals]
+
+def print_sweep(filenames, jobs, metric, ref_days, future_days, thresholds, max_stds, min_references, cache_dir = SERIES_CACHE_DIR):
+    """Print a table of the regressions found in the files in `filenames` for every combination of the given detection parameter values (see `find_regressions`)."""
+    grid = []
+    for nr_ref_days, nr_future_days, threshold, max_std, min_reference_count in itertools.product(ref_days, future_days, thresholds, max_stds, min_references):
+        threshold, max_std = metric_criteria(metric, threshold, max_std)
+        if min_reference_count is None: min_reference_count = nr_ref_days / 2 + 1
+        grid.append((nr_ref_days, nr_future_days, threshold, max_std, min_reference_count))
+
+    print "ref_days\tfuture_days\tthreshold\tmax_std\tmin_references\tregressions\thistograms"
+    for parameters, (regression_count, histogram_count) in zip(grid, sweep_regressions(filenames, grid, jobs, cache_dir=cache_dir, metric=metric)):
+        print "\t".join(str(value) for value in parameters + (regression_count, histogram_count))
+
 def main():
+    if args.sweep:
+        print_sweep(
+            find_histogram_files(HISTOGRAMS_DIR), args.jobs, args.metric,
+            args.ref_days, args.future_days, args.threshold, args.max_std, args.min_references,
+            cache_dir=None if args.no_series_cache else args.series_cache
+        )
+        return
+
     regressions = []
 
     # This is the same Histograms.json as the one in mozilla-central
@@ -194,10 +595,13 @@ def main():
     #process_file('./histograms/FX_TAB_ANIM_ANY_FRAME_INTERVAL_MS.json', regressions)
 
     # Process all histograms, detecting and collecting all the regressions found
-    for subdir, dirs, files in os.walk('./histograms'):
-        for file in files:
-            if file.endswith(".json"):
-                regressions += process_file(subdir + "/" + file)
+    regressions += detect_regressions(
+        find_histogram_files(HISTOGRAMS_DIR), args.jobs,
+        cache_dir=None if args.no_series_cache else args.series_cache,
+        checkpoint_dir=args.checkpoints if args.incremental else None,
+        nr_ref_days=args.ref_days[0], nr_future_days=args.future_days[0],
+        metric=args.metric, threshold=args.threshold[0], max_std=args.max_std[0], min_references=args.min_references[0]
+    )
 
     # Load past regressions
     past_regressions = {}
@@ -237,10 +641,120 @@ def main():
     with open(REGRESSION_FILENAME, 'w') as f:
         json.dump(past_regressions ,f, indent=4)
 
+def run_tests():
+    random = numpy.random.RandomState(42)
+
+    # the Bhattacharyya distances match OpenCV's, including for empty histograms
+    hists = numpy.vstack([random.rand(20, 30), numpy.zeros((2, 30)), random.rand(1, 30), random.rand(1, 30) * 1e-5]).astype('float32')
+    refs = numpy.vstack([random.rand(20, 30), random.rand(1, 30), numpy.zeros((2, 30)), random.rand(1, 30) * 1e-5]).astype('float32') # the last pair is too small to be rescaled
+    hists[:10] /= numpy.sum(hists[:10], axis=1, keepdims=True) # normalized and unnormalized histograms
+    refs[:10] /= numpy.sum(refs[:10], axis=1, keepdims=True)
+    distances = bat_distances(hists.astype('float64'), refs.astype('float64'))
+    try:
+        import cv2
+        expected = [cv2.compareHist(hist, ref, 3) for hist, ref in zip(hists, refs)]
+    except ImportError: # OpenCV's formula, from `compareHist` in modules/imgproc/src/histogram.cpp
+        expected = []
+        for hist, ref in zip(hists.astype('float64'), refs.astype('float64')):
+            scale = numpy.sum(hist) * numpy.sum(ref)
+            scale = 1 / numpy.sqrt(scale) if abs(scale) > FLT_EPSILON else 1
+            expected.append(numpy.sqrt(max(1 - numpy.sum(numpy.sqrt(hist * ref)) * scale, 0)))
+    assert numpy.allclose(distances, expected, atol=1e-6)
+    assert numpy.allclose([bat_distance(hist, ref) for hist, ref in zip(hists, refs)], expected, atol=1e-6)
+    assert numpy.allclose(bat_distance_matrix(hists, 3)[5, 3], bat_distance(hists[5], hists[3])) and numpy.isnan(bat_distance_matrix(hists, 3)[5, 1])
+
+    # streaming the elements of a JSON array gives the same result as `json.load`, whichever chunk boundaries elements are split across
+    documents = [
+        '[]', ' [ ] ', '[1]', '[12345, 678.5e-3, -9]', '["a,]", "[b", "\\"", {"c": [1, 2]}]',
+        '[{"date": "2016-01-01", "values": [1, 20, 300], "buckets": [0, 1, 2]},\n {"date": "2016-01-02", "values": [4000, 50000, 6], "buckets": [0, 1, 2]}]\n',
+        '[ true , false , null , [] , {} , 1e10 ]',
+    ]
+    for document in documents:
+        for chunk_size in [1, 2, 3, 5, 7, JSON_CHUNK_SIZE]:
+            assert list(iter_json_array(StringIO.StringIO(document), chunk_size)) == json.loads(document), document
+    for document in ['', '{}', '[1,', '[1 2]', '[1', '[}']:
+        try:
+            list(iter_json_array(StringIO.StringIO(document), 2))
+            assert False, "invalid JSON array should be rejected: " + document
+        except ValueError: pass
+
+    # the vectorized detection finds the same regressions as comparing each day separately
+    def find_regressions_per_day(counts, nr_ref_days, nr_future_days): # the original detection loop
+        regressions = numpy.zeros(len(counts), dtype=bool)
+        for i in range(len(counts) - nr_future_days):
+            if has_not_enough_data(counts[i]): continue
+            suspicious = []
+            for j in range(i, min(i + nr_future_days + 1, len(counts))):
+                distances = [bat_distance(normalize(counts[j]), normalize(counts[k])) for k in range(max(i - nr_ref_days, 0), i) if not has_not_enough_data(counts[k])]
+                suspicious.append(len(distances) > nr_ref_days / 2 and distances[-1] > 0.12 and numpy.std(distances) <= 0.01)
+            regressions[i] = all(suspicious)
+        return regressions
+
+    before, after = random.dirichlet(numpy.ones(20)), random.dirichlet(numpy.ones(20))
+    for size, change in [(40, 20), (40, 5), (12, 9), (3, 1), (1, 0), (0, 0)]:
+        counts = numpy.array([random.multinomial(100000, before if day < change else after) for day in range(size)], dtype='float64').reshape(size, 20)
+        counts[random.rand(size) < 0.15] /= 200 # days without enough data
+        for nr_ref_days, nr_future_days in [(7, 2), (3, 0), (5, 1), (1, 4)]:
+            normalized, enough_data, distance_matrix = prepare_series((numpy.arange(size), counts), nr_ref_days + nr_future_days)
+            found = find_regressions(enough_data, distance_matrix, nr_ref_days, nr_future_days, 0.12, 0.01)
+            assert numpy.array_equal(found, find_regressions_per_day(counts, nr_ref_days, nr_future_days)), (size, change, nr_ref_days, nr_future_days)
+            if size == 40 and change == 20 and enough_data[change] and nr_ref_days == 7: assert found[change] # the change should be found
+    assert compare_histogram((numpy.array([], dtype="datetime64[D]"), numpy.zeros((0, 0))), "EMPTY", []) == []
+
+    # detecting regressions one day at a time from checkpoints finds the same regressions as analyzing the whole series at once,
+    # whether each day's series starts at the beginning or only covers the last few days
+    dates = numpy.datetime64("2016-01-01") + numpy.arange(40)
+    counts = numpy.array([random.multinomial(100000, before if day < 20 else after) for day in range(40)], dtype='float64')
+    counts[random.rand(40) < 0.15] /= 200
+    expected = compare_histogram((dates, counts), "TEST", range(20))
+    assert expected
+    for first_kept in [lambda end: 0, lambda end: max(end - 4, 0)]:
+        found, checkpoint = [], None
+        for end in range(1, 41):
+            regressions, checkpoint = compare_since_checkpoint((dates[first_kept(end):end], counts[first_kept(end):end]), checkpoint, "TEST", range(20))
+            found += regressions
+        assert [regression[0] for regression in found] == [regression[0] for regression in expected]
+        assert all(numpy.array_equal(a, b) for regression1, regression2 in zip(found, expected) for a, b in zip(regression1[3], regression2[3]))
+
+    print "All tests passed!"
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Telemetry Regression Detector",
                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes to spread the histogram files over (1 disables multiprocessing)")
+    parser.add_argument("--series-cache", default=SERIES_CACHE_DIR,
+                        help="Directory to cache parsed histogram evolutions in")
+    parser.add_argument("--no-series-cache", action="store_true",
+                        help="Always parse the exported histogram evolutions, without reading or writing the series cache")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only analyze the dates that were added since the previous incremental run, using the checkpoints it stored")
+    parser.add_argument("--checkpoints", default=CHECKPOINT_DIR,
+                        help="Directory to store the per-measure checkpoints used by --incremental in")
+    parser.add_argument("--metric", choices=sorted(DISTANCE_METRICS), default="bhattacharyya",
+                        help="Distance metric to compare histograms with (bhattacharyya-opencv computes the Bhattacharyya distance using OpenCV)")
+    parser.add_argument("--ref-days", type=int, nargs="+", default=[7],
+                        help="Number of days before each analyzed day to compare it to")
+    parser.add_argument("--future-days", type=int, nargs="+", default=[2],
+                        help="Number of days after each analyzed day that must also differ from the reference days")
+    parser.add_argument("--threshold", type=float, nargs="+", default=[None],
+                        help="Distance above which a day differs from the last reference day (defaults to the metric's threshold)")
+    parser.add_argument("--max-std", type=float, nargs="+", default=[None],
+                        help="Maximum standard deviation of a day's distances to the reference days (defaults to the metric's maximum)")
+    parser.add_argument("--min-references", type=int, nargs="+", default=[None],
+                        help="Minimum number of reference days with enough data (defaults to more than half of --ref-days)")
+    parser.add_argument("--sweep", action="store_true",
+                        help="Rather than detecting regressions, print the number of regressions found for every combination of the values given for "
+                             "--ref-days, --future-days, --threshold, --max-std and --min-references")
+
+    parser.add_argument("--test", action="store_true",
+                        help="Run the internal tests instead of detecting regressions")
 
     args = parser.parse_args()
+    if args.test:
+        run_tests()
+        sys.exit()
+    if not args.sweep and any(len(values) > 1 for values in (args.ref_days, args.future_days, args.threshold, args.max_std, args.min_references)):
+        parser.error("multiple detection parameter values are only allowed with --sweep")
 
     main()
@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Replay an archive of histogram evolutions through the regression detector
+# in alert.py day by day, reporting how it would have behaved over time.
+
+import os
+import time
+import argparse
+import functools
+import multiprocessing
+
+import numpy
+
+import alert
+
+def replay_file(filename, cache_dir = alert.SERIES_CACHE_DIR, nr_ref_days = 7, nr_future_days = 2, **options):
+    """Replay the series in the exported histogram file `filename` through the detector one date at a time, as if each of its dates was the day of a daily incremental run.
+
+Returns a tuple `(MEASURE_NAME, RUNTIME, ALERTS)`, where `RUNTIME` is the number of seconds spent loading and replaying the series, and `ALERTS` is a list of pairs `(ALERT_DATE, REGRESSION_DATE)` for each regression found, with the date that it would have been reported on. Any other keyword arguments are passed on to `alert.compare_histogram`."""
+    start = time.time()
+    measure_name, _ = os.path.splitext(os.path.basename(filename))
+    series = alert.load_series(filename, cache_dir)
+    if series is None:
+        return measure_name, time.time() - start, []
+
+    dates, counts, buckets = series
+    alerts, checkpoint = [], None
+    for today in range(len(dates)):
+        # each day, only the newly available date is added, and the checkpoint from the previous day keeps the comparison window small
+        regressions, checkpoint = alert.compare_since_checkpoint(
+            (dates[:today + 1], counts[:today + 1]), checkpoint, measure_name, buckets, nr_ref_days, nr_future_days, **options
+        )
+        alerts += [(dates[today].tolist(), regression[0]) for regression in regressions]
+    return measure_name, time.time() - start, alerts
+
+def print_report(results, slowest_count = 10):
+    """Print the alerts per day, detection latencies and runtimes of the replay results `results` (see `replay_file`)."""
+    alerts = [alert_entry for measure_name, runtime, measure_alerts in results for alert_entry in measure_alerts]
+
+    print "Alerts per day:"
+    alerts_per_day = {}
+    for alert_date, regression_date in alerts:
+        alerts_per_day[alert_date] = alerts_per_day.get(alert_date, 0) + 1
+    for alert_date, count in sorted(alerts_per_day.items()):
+        print "  {}: {}".format(alert_date.isoformat(), count)
+
+    print "Detection latency (days from the start of a regression to its alert):"
+    if alerts:
+        latencies = numpy.array([(alert_date - regression_date).days for alert_date, regression_date in alerts])
+        print "  {} alerts, mean {:.2f}, median {:.1f}, maximum {}".format(len(latencies), numpy.mean(latencies), numpy.median(latencies), numpy.max(latencies))
+    else:
+        print "  no alerts"
+
+    print "Runtime per histogram:"
+    runtimes = numpy.array([runtime for measure_name, runtime, measure_alerts in results])
+    if len(runtimes):
+        print "  {} histograms, total {:.2f}s, mean {:.4f}s, maximum {:.4f}s".format(len(runtimes), numpy.sum(runtimes), numpy.mean(runtimes), numpy.max(runtimes))
+        for measure_name, runtime, measure_alerts in sorted(results, key=lambda result: result[1], reverse=True)[:slowest_count]:
+            print "  {:.4f}s {}".format(runtime, measure_name)
+    else:
+        print "  no histograms"
+
+def main():
+    start = time.time()
+    replay = functools.partial(
+        replay_file, cache_dir=None if args.no_series_cache else args.series_cache,
+        nr_ref_days=args.ref_days, nr_future_days=args.future_days,
+        metric=args.metric, threshold=args.threshold, max_std=args.max_std, min_references=args.min_references
+    )
+    results = list(alert.map_files(replay, alert.find_histogram_files(args.archive), args.jobs))
+    print_report(results)
+    print "Replayed {} histograms in {:.2f}s".format(len(results), time.time() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telemetry Regression Detector Backtest",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("archive", nargs="?", default=alert.HISTOGRAMS_DIR,
+                        help="Directory containing the histogram evolutions to replay, as exported by the node exporter")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes to spread the histogram files over (1 disables multiprocessing)")
+    parser.add_argument("--series-cache", default=alert.SERIES_CACHE_DIR,
+                        help="Directory to cache parsed histogram evolutions in")
+    parser.add_argument("--no-series-cache", action="store_true",
+                        help="Always parse the exported histogram evolutions, without reading or writing the series cache")
+    parser.add_argument("--metric", choices=sorted(alert.DISTANCE_METRICS), default="bhattacharyya",
+                        help="Distance metric to compare histograms with")
+    parser.add_argument("--ref-days", type=int, default=7,
+                        help="Number of days before each analyzed day to compare it to")
+    parser.add_argument("--future-days", type=int, default=2,
+                        help="Number of days after each analyzed day that must also differ from the reference days")
+    parser.add_argument("--threshold", type=float,
+                        help="Distance above which a day differs from the last reference day (defaults to the metric's threshold)")
+    parser.add_argument("--max-std", type=float,
+                        help="Maximum standard deviation of a day's distances to the reference days (defaults to the metric's maximum)")
+    parser.add_argument("--min-references", type=int,
+                        help="Minimum number of reference days with enough data (defaults to more than half of --ref-days)")
+
+    args = parser.parse_args()
+
+    main()
@@ -4,13 +4,19 @@
 
 import json
 import os
+import re
 import sys
 import urllib2
+import bisect
+import tempfile
+import shutil
+from StringIO import StringIO
 from datetime import datetime, date, timedelta
 
-from bs4 import BeautifulSoup
-from mail import send_ses
-from mozilla_versions import version_compare, version_get_major, version_normalize_nightly
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+from mail import Mailer, SMTPBackend, FileBackend
+from mozilla_versions import version_sort_key, version_get_major, version_normalize_nightly
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -18,12 +24,120 @@ HISTOGRAMS_FILE           = os.path.join(SCRIPT_DIR, "..", "Histograms.json") #
 SCALARS_FILE              = os.path.join(SCRIPT_DIR, "..", "Scalars.json") # scalars definition file
 EMAIL_TIME_BEFORE         = timedelta(weeks=6) # first expiry notification is to be sent out exactly 6 weeks before the release date
 EMAIL_TIME_BEFORE_SHERIFF = timedelta(weeks=2) # second expiry notification (which includes sheriffs) is to be sent out exactly 2 weeks before the release date
+NOTIFICATION_HORIZONS     = [(EMAIL_TIME_BEFORE, False), (EMAIL_TIME_BEFORE_SHERIFF, True)] # pairs (TIME_BEFORE_RELEASE, NOTIFY_SHERIFFS) for each expiry notification
+NOTIFICATION_CATCH_UP     = timedelta(weeks=1) # expiry notifications missed on the day they were due are still sent this long afterwards
+NOTIFICATION_LEDGER       = os.path.join(SCRIPT_DIR, "..", "expiry_notifications.json") # record of the expiry notifications that were sent
 FROM_ADDR                 = "telemetry-alerts@mozilla.com" # email address to send alerts from
 GENERAL_TELEMETRY_ALERT   = "dev-telemetry-alerts@lists.mozilla.org" # email address that will receive all notifications, 6 weeks beforeexpiry
 SHERIFF_ALERT             = "sheriffs@mozilla.org" # email address for sheriff notifications
+CALENDAR_API_URL          = "https://wiki.mozilla.org/api.php?action=parse&format=json&page=Release_Management/Calendar" # wiki API URL of the parsed release calendar page
+CALENDAR_REVISION_URL     = "https://wiki.mozilla.org/api.php?action=query&format=json&prop=revisions&rvprop=ids&titles=Release_Management/Calendar" # wiki API URL of the latest revision ID of the release calendar page
+RELEASE_DATES_CACHE       = os.path.join(SCRIPT_DIR, "..", "release_dates.json") # cache of the release dates parsed from the release calendar
+RELEASE_DATES_MAX_AGE     = timedelta(hours=12) # age after which the release dates cache is checked against the latest revision of the release calendar
+RELEASE_CALENDAR_FIXTURE  = os.path.join(SCRIPT_DIR, "fixtures", "release_calendar.html") # local copy of the release calendar used by the tests
+CALENDAR_HEADING_IDS      = ["Future_branch_dates", "Past_branch_dates"] # IDs in the headings of the release calendar's version tables, the later ones taking precedence
+CALENDAR_CHUNK_SIZE       = 1 << 13 # number of characters of the release calendar to parse at a time, before checking whether all of its version tables were found
+
+class CalendarTableParser(HTMLParser):
+    """Extracts the rows of the first table following each heading that contains an element with one of the IDs in `heading_ids`, without building a tree of the whole document.
+
+After feeding it the document, `tables` maps each ID to a list of pairs `(TD_TEXTS, TH_TEXTS)` for the rows of its table, where each cell's text is that of its first hyperlink, if it has one."""
+    VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+    IMPLIED_END_TAGS = { # open table elements that are closed by each start tag, when their end tags are omitted
+        "td": {"td", "th"}, "th": {"td", "th"}, "tr": {"tr"},
+        "thead": {"tr", "thead", "tbody", "tfoot"}, "tbody": {"tr", "thead", "tbody", "tfoot"}, "tfoot": {"tr", "thead", "tbody", "tfoot"},
+    }
 
-def get_version_table_dates(table):
-    """Given a version table, obtains a dictionary mapping Firefox version numbers to their intended release date.
+    def __init__(self, heading_ids):
+        HTMLParser.__init__(self)
+        self.heading_ids = set(heading_ids)
+        self.tables = {}
+        self.stack = []             # names of the open elements
+        self.heading = None         # pair (ID, DEPTH) for the heading whose table comes next, once the heading is found
+        self.table = None           # pair (ID, DEPTH) for the table being extracted
+        self.row = None
+        self.cell = None            # list of text in the cell being extracted
+        self.link = None            # list of text in the first hyperlink of the cell being extracted, if any
+        self.in_link = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_ELEMENTS:
+            return
+        if self.table is not None and tag in self.IMPLIED_END_TAGS: # end tags that HTML allows to be omitted, such as `</td>` before another cell
+            self.close_open_element(self.IMPLIED_END_TAGS[tag])
+        depth = len(self.stack)
+        self.stack.append(tag)
+        if self.table is not None:
+            if tag == "tr":
+                self.row = ([], [])
+            elif tag in {"td", "th"} and self.row is not None:
+                self.cell, self.link = [], None
+            elif tag == "a" and self.cell is not None and self.link is None:
+                self.link, self.in_link = [], True
+        elif self.heading is not None:
+            if tag == "table" and depth == self.heading[1]: # the next table alongside the heading
+                self.table, self.heading = (self.heading[0], depth), None
+                self.tables[self.table[0]] = []
+        else:
+            element_id = dict(attrs).get("id")
+            if element_id in self.heading_ids and "h2" in self.stack:
+                self.heading = (element_id, self.stack.index("h2"))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in self.VOID_ELEMENTS:
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def close_open_element(self, tags):
+        """Close the innermost open element with one of the names in `tags` that belongs to the table being extracted, if any, along with the elements inside it."""
+        for index in xrange(len(self.stack) - 1, self.table[1], -1):
+            if self.stack[index] == "table": # elements outside a nested table aren't closed by its contents
+                return
+            if self.stack[index] in tags:
+                self.handle_endtag(self.stack[index])
+                return
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while self.stack:
+            open_tag = self.stack.pop()
+            if self.table is not None:
+                self.end_table_element(open_tag)
+            if open_tag == tag:
+                break
+        if self.heading is not None and len(self.stack) < self.heading[1]: # the heading's parent ended without a table
+            self.heading = None
+
+    def end_table_element(self, tag):
+        if tag == "a":
+            self.in_link = False
+        elif tag in {"td", "th"} and self.cell is not None and self.row is not None:
+            self.row[0 if tag == "td" else 1].append(u"".join(self.link if self.link is not None else self.cell))
+            self.cell, self.link, self.in_link = None, None, False
+        elif tag == "tr" and self.row is not None:
+            self.tables[self.table[0]].append(self.row)
+            self.row = None
+        elif tag == "table" and len(self.stack) == self.table[1]:
+            self.table = None
+
+    def is_done(self):
+        return len(self.tables) == len(self.heading_ids) and self.table is None
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+            if self.in_link:
+                self.link.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(unichr(name2codepoint[name]) if name in name2codepoint else u"&" + name + u";")
+
+    def handle_charref(self, name):
+        self.handle_data(unichr(int(name[1:], 16) if name.lower().startswith("x") else int(name)))
+
+def get_version_table_dates(rows):
+    """Given the rows of a version table as pairs `(TD_TEXTS, TH_TEXTS)` (see `CalendarTableParser`), obtains a dictionary mapping Firefox version numbers to their intended release date.
 
 The table is expected to be in the following form:
 
@@ -41,28 +155,17 @@ The table is expected to be in the following form:
       (...other rows...)
     </table>"""
     result = {}
-    for row in table.find_all("tr"):
-        # obtain the row and make sure it is valid (this skips the header row and any minor version rows)
-        fields = list(row.find_all("td"))
+    for fields, headers in rows:
+        # make sure the row is valid (this skips the header row and any minor version rows)
         if len(fields) < 4: continue # not enough fields in the row, probably a header row
-        is_valid = True
-        for i in xrange(4): # ensure that each column represents a Firefox version
-            field = fields[i]
-            if field.find("a") is not None:
-                # replace the cell with the hyperlink field
-                field = field.find("a")
-                fields[i] = field
-            if "Firefox" not in field.string:
-                is_valid = False
-                break
-        if not is_valid: continue
+        if any("Firefox" not in field for field in fields[:4]): continue # ensure that each column represents a Firefox version
 
-        nightly_version = str(version_get_major(fields[-4].string.replace("Firefox ", ""))) + ".0a1"
-        aurora_version  = str(version_get_major(fields[-3].string.replace("Firefox ", ""))) + ".0a2"
-        beta_version    = str(version_get_major(fields[-2].string.replace("Firefox ", ""))) + ".0b1"
-        release_version = str(version_get_major(fields[-1].string.replace("Firefox ", ""))) + ".0"
+        nightly_version = str(version_get_major(fields[-4].replace("Firefox ", ""))) + ".0a1"
+        aurora_version  = str(version_get_major(fields[-3].replace("Firefox ", ""))) + ".0a2"
+        beta_version    = str(version_get_major(fields[-2].replace("Firefox ", ""))) + ".0b1"
+        release_version = str(version_get_major(fields[-1].replace("Firefox ", ""))) + ".0"
 
-        release_date_string = list(row.find_all("th"))[-1].string.strip(" \t\r\n*")
+        release_date_string = headers[-1].strip(" \t\r\n*")
         try:
             release_date = datetime.strptime(release_date_string, "%Y-%m-%d").date()
             result[aurora_version] = release_date
@@ -70,17 +173,17 @@ The table is expected to be in the following form:
             result[release_version] = release_date
         except ValueError: pass
 
-        nightly_date_string = list(row.find_all("th"))[0].string.strip(" \t\r\n*")
+        nightly_date_string = headers[0].strip(" \t\r\n*")
         try:
             nightly_date = datetime.strptime(nightly_date_string, "%Y-%m-%d").date()
             result[nightly_version] = nightly_date
         except ValueError: pass
     return result
 
-def get_release_dates():
-    """Obtain a dictionary mapping future Firefox version numbers to their intended release date.
+def get_calendar_dates(calendar_html):
+    """Obtain a dictionary mapping Firefox version numbers to their intended release date from the HTML of the RapidRelease page of the Mozilla Wiki.
 
-Takes data from the RapidRelease page of the Mozilla Wiki. The page is expected to be in the following form:
+The page is expected to be in the following form:
 
     (...beginning of document...)
     <h2><span id="Future_branch_dates">(TITLE)</span></h2>
@@ -91,51 +194,150 @@ Takes data from the RapidRelease page of the Mozilla Wiki. The page is expected
     (...anything other than a table...)
     (...version table...)
     (...rest of document...)"""
-    response = json.loads(urllib2.urlopen("https://wiki.mozilla.org/api.php?action=parse&format=json&page=Release_Management/Calendar").read())
-    soup = BeautifulSoup(response["parse"]["text"]["*"], "html5lib")
+    # only parse the page from the first heading until the last table
+    positions = [calendar_html.find('id="{}"'.format(heading_id)) for heading_id in CALENDAR_HEADING_IDS]
+    start = max(calendar_html.rfind("<h2", 0, min(positions)), 0) if min(positions) >= 0 else 0
+    parser = CalendarTableParser(CALENDAR_HEADING_IDS)
+    for offset in xrange(start, len(calendar_html), CALENDAR_CHUNK_SIZE):
+        parser.feed(calendar_html[offset:offset + CALENDAR_CHUNK_SIZE])
+        if parser.is_done(): break
+    parser.close()
+
+    # scrape for future release date tables, then past release date tables
+    result = {}
+    for heading_id in CALENDAR_HEADING_IDS:
+        table_dates = get_version_table_dates(parser.tables.get(heading_id, []))
+        if not table_dates: # most likely the layout of the page changed, which shouldn't go unnoticed
+            raise ValueError("No release dates found in the version table under the heading {} of the release calendar".format(heading_id))
+        result.update(table_dates)
+    return result
 
-    # scrape for future release date tables
-    table = soup.find(id="Future_branch_dates").find_parent("h2").find_next_sibling("table")
-    result = get_version_table_dates(table)
+def read_release_dates_cache(cache_file):
+    """Returns a tuple `(CACHE_TIME, REVISION_ID, RELEASE_DATES)` from the release dates cache `cache_file`, or `None` if it can't be read."""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        release_dates = {version: datetime.strptime(release_date, "%Y-%m-%d").date() for version, release_date in cache["release_dates"].items()}
+        return datetime.strptime(cache["cached"], "%Y-%m-%dT%H:%M:%S"), cache["revid"], release_dates
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+def write_release_dates_cache(cache_file, revision_id, release_dates):
+    cache = {
+        "cached": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "revid": revision_id,
+        "release_dates": {version: release_date.isoformat() for version, release_date in release_dates.items()},
+    }
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(cache_file)), delete=False) as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(f.name, cache_file)
 
-    # scrape for past release date tables
-    table = soup.find(id="Past_branch_dates").find_parent("h2").find_next_sibling("table")
-    result.update(get_version_table_dates(table))
-    return result
+def get_latest_revision_id():
+    response = json.loads(urllib2.urlopen(CALENDAR_REVISION_URL, timeout=30).read())
+    return response["query"]["pages"].values()[0]["revisions"][0]["revid"]
 
-def email_histogram_subscribers(current_date, target_date, notifiable_histograms, expired_histograms, notify_sheriffs = False, dry_run = False):
+def get_release_dates(calendar_file = None, cache_file = RELEASE_DATES_CACHE, max_age = RELEASE_DATES_MAX_AGE):
+    """Obtain a dictionary mapping future Firefox version numbers to their intended release date.
+
+Takes data from the RapidRelease page of the Mozilla Wiki (see `get_calendar_dates`), or from the local copy `calendar_file` of it if given, either as the HTML of the page or as the JSON response of the wiki API.
+
+The release dates from the wiki are cached in `cache_file` (unless it is `None`). Once the cache is older than `max_age`, the page is only parsed again if it has changed since, and if the wiki can't be reached the cached release dates are used regardless of their age."""
+    if calendar_file is not None:
+        with open(calendar_file) as f:
+            calendar = f.read()
+        if calendar_file.endswith(".json"):
+            calendar = json.loads(calendar)["parse"]["text"]["*"]
+        return get_calendar_dates(calendar)
+
+    cache = read_release_dates_cache(cache_file) if cache_file is not None else None
+    if cache is not None and datetime.now() - cache[0] < max_age:
+        return cache[2]
+
+    try:
+        if cache is not None and get_latest_revision_id() == cache[1]: # the page hasn't changed, so the cached release dates are still up to date
+            release_dates = cache[2]
+            write_release_dates_cache(cache_file, cache[1], release_dates)
+            return release_dates
+
+        response = json.loads(urllib2.urlopen(CALENDAR_API_URL, timeout=30).read())
+    except (urllib2.URLError, IOError, ValueError, KeyError, IndexError) as e:
+        if cache is None: raise
+        print "Could not update the release calendar ({}), using the cached release dates from {}".format(e, cache[0])
+        return cache[2]
+
+    release_dates = get_calendar_dates(response["parse"]["text"]["*"])
+    if cache_file is not None and release_dates: # an empty result would otherwise be used until the page changes
+        write_release_dates_cache(cache_file, response["parse"].get("revid"), release_dates)
+    return release_dates
+
+class ReleaseCalendar:
+    """Release dates of Firefox versions, from the dictionary `release_dates` mapping version numbers to their release dates, with the versions kept sorted so that the first release at or after any version can be found quickly."""
+    def __init__(self, release_dates):
+        self.release_dates = release_dates
+        self.versions = sorted(release_dates.keys(), key=version_sort_key)
+        self.keys = [version_sort_key(version) for version in self.versions]
+
+    def __contains__(self, version):
+        return version in self.release_dates
+
+    def __getitem__(self, version):
+        return self.release_dates[version]
+
+    def __len__(self):
+        return len(self.release_dates)
+
+    def get_first_release_date(self, version):
+        """Returns the release date of the oldest version that is not older than `version`, or `None` if there is no such version."""
+        index = bisect.bisect_left(self.keys, version_sort_key(version))
+        return self.release_dates[self.versions[index]] if index < len(self.versions) else None
+
+def format_histogram_line(name, entry, tense):
+    """Returns the line listing the histogram `name` with the entry `entry` in notification emails, where `tense` is "expires" or "expired"."""
+    return "* {name} {tense} in version {version} ({watchers}) - {description}".format(
+        name=name, tense=tense, version=version_normalize_nightly(entry["expires_in_version"]),
+        watchers="watched by {}".format(", ".join(email for email in entry["alert_emails"])) if "alert_emails" in entry else "no watchers",
+        description=entry["description"]
+    )
+
+def get_notification_emails(entry, notify_sheriffs = False):
+    """Returns the emails that are notified about the expiry of the histogram entry `entry`."""
+    general_emails = [GENERAL_TELEMETRY_ALERT, SHERIFF_ALERT] if notify_sheriffs else [GENERAL_TELEMETRY_ALERT]
+    return entry.get("alert_emails", []) + general_emails
+
+def email_histogram_subscribers(current_date, target_date, notifiable_histograms, expired_histograms, notify_sheriffs = False, dry_run = False, mailer = None, notified = frozenset()):
+    """Emails the subscribers of each histogram in `notifiable_histograms` using `mailer` (or a new `Mailer` if not given), leaving out the histograms in pairs `(HISTOGRAM_NAME, EMAIL)` in `notified`.
+
+Returns a list of tuples `(EMAIL, HISTOGRAM_NAMES, ERROR)` for the emails sent, where `ERROR` is as returned by `Mailer.send_all`. If `dry_run` is set, the emails are printed rather than sent and nothing is returned."""
     if len(notifiable_histograms) == 0: # nothing to send any alerts about
-        return
+        return []
 
-    # organize histograms into buckets indexed by email
-    email_histogram_names = {GENERAL_TELEMETRY_ALERT: []}
-    for histogram_name, entry in notifiable_histograms:
-        for email in entry.get("alert_emails", []):
-            if email not in email_histogram_names: email_histogram_names[email] = []
-            email_histogram_names[email].append(histogram_name)
-        email_histogram_names[GENERAL_TELEMETRY_ALERT].append(histogram_name)
+    # render the line for each histogram once, and index the histograms by the emails subscribed to them
+    expiring_lines = [format_histogram_line(name, entry, "expires") for name, entry in notifiable_histograms]
+    general_emails = [GENERAL_TELEMETRY_ALERT, SHERIFF_ALERT] if notify_sheriffs else [GENERAL_TELEMETRY_ALERT] # if the sheriffs are to be alerted, they should get a list of all expiring histograms
+    email_histogram_indices = {email: set() for email in general_emails}
+    for i, (histogram_name, entry) in enumerate(notifiable_histograms):
+        for email in get_notification_emails(entry, notify_sheriffs):
+            if (histogram_name, email) not in notified:
+                email_histogram_indices.setdefault(email, set()).add(i)
 
-    if notify_sheriffs: # if the sheriffs are to be alerted, they should get a list of all expiring histograms
-        email_histogram_names[SHERIFF_ALERT] = email_histogram_names[GENERAL_TELEMETRY_ALERT]
+    full_expiring_list = "\n".join(expiring_lines)
+    expired_list = "\n".join(format_histogram_line(name, entry, "expired") for name, entry in expired_histograms)
 
     # send emails to users detailing the histograms that they are subscribed to that are expiring
-    for email, expiring_histogram_names in email_histogram_names.items():
-        expiring_list = "\n".join("* {name} expires in version {version} ({watchers}) - {description}".format(
-            name=name, version=version_normalize_nightly(entry["expires_in_version"]),
-            watchers="watched by {}".format(", ".join(email for email in entry["alert_emails"])) if "alert_emails" in entry else "no watchers",
-            description=entry["description"]
-        ) for name, entry in notifiable_histograms if name in expiring_histogram_names)
+    emails, email_histogram_names = [], []
+    for email, histogram_indices in email_histogram_indices.items():
+        if len(histogram_indices) == 0: # everything was already notified
+            continue
+        if len(histogram_indices) == len(expiring_lines):
+            expiring_list = full_expiring_list
+        else: # list the histograms in the same order as they were given
+            expiring_list = "\n".join(expiring_lines[i] for i in sorted(histogram_indices))
         if email != GENERAL_TELEMETRY_ALERT: # alert to a normal watcher
             email_body = (
                 "The following histograms will be expiring on {}, and should be removed from the codebase, or have their expiry versions updated:\n\n{}\n\n"
                 "This is an automated message sent by Cerberus. See https://github.com/mozilla/cerberus for details and source code."
             ).format(target_date, expiring_list)
         else: # alert to the general Telemetry alert mailing list
-            expired_list = "\n".join("* {name} expired in version {version} ({watchers}) - {description}".format(
-                name=name, version=version_normalize_nightly(entry["expires_in_version"]),
-                watchers="watched by {}".format(", ".join(email for email in entry["alert_emails"])) if "alert_emails" in entry else "no watchers",
-                description=entry["description"]
-            ) for name, entry in expired_histograms)
             email_body = (
                 "The following histograms will be expiring on {}, and should be removed from the codebase, or have their expiry versions updated:\n\n{}\n\n"
                 "The following histograms are expired as of {}:\n\n{}\n\n"
@@ -145,26 +347,60 @@ def email_histogram_subscribers(current_date, target_date, notifiable_histograms
             print("Email notification for {}:\n===============================================\n{}\n===============================================\n".format(email, email_body))
         else:
             print("Sending email notification to {} with body:\n\n{}\n".format(email, email_body))
-            send_ses(FROM_ADDR, "Telemetry Histogram Expiry", email_body, email)
-
-def is_expiring(histogram_entry, target_date, release_dates, include_past = False):
-    """Returns `True` if the histogram `histogram_entry` is expiring on the date `target_date`, `False` otherwise."""
+            emails.append((FROM_ADDR, "Telemetry Histogram Expiry", email_body, email))
+            email_histogram_names.append([notifiable_histograms[i][0] for i in sorted(histogram_indices)])
+
+    if dry_run:
+        return []
+    results = (mailer if mailer is not None else Mailer()).send_all(emails)
+    for email, error in results:
+        if error:
+            print("Could not send email notification to {}: {}".format(email, error))
+    return [(email, histogram_names, error) for (email, error), histogram_names in zip(results, email_histogram_names)]
+
+def read_notification_ledger(ledger_file):
+    """Returns the set of notifications that were sent according to `ledger_file`, as tuples `(HISTOGRAM_NAME, DAYS_BEFORE_RELEASE, EMAIL, RELEASE_DATE)`, where `RELEASE_DATE` is a YYYY-MM-DD string."""
+    try:
+        with open(ledger_file) as f:
+            return set(tuple(notification) for notification in json.load(f))
+    except IOError:
+        return set()
+
+def write_notification_ledger(ledger_file, ledger):
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(ledger_file)), delete=False) as f:
+        json.dump(sorted(ledger), f, indent=2)
+    os.rename(f.name, ledger_file)
+
+def get_mailer():
+    """Returns a `Mailer` that writes emails to the directory named by the MAIL_OUTPUT_DIR environment variable if set, or sends them to the SMTP server named by the SMTP_SERVER environment variable (as HOST or HOST:PORT) if set, or sends them with Amazon SES otherwise."""
+    if os.environ.get("MAIL_OUTPUT_DIR"):
+        return Mailer(FileBackend(os.environ["MAIL_OUTPUT_DIR"]))
+    if os.environ.get("SMTP_SERVER"):
+        host, _, port = os.environ["SMTP_SERVER"].partition(":")
+        return Mailer(SMTPBackend(host, int(port) if port else 25))
+    return Mailer()
+
+def get_expiry_date(histogram_entry, release_dates):
+    """Returns a pair `(RELEASE_DATE, ESTIMATED_RELEASE_DATE)` for the histogram `histogram_entry`, where `RELEASE_DATE` is the release date of its expiry version, or `None` if that isn't known, and `ESTIMATED_RELEASE_DATE` is the release date of the oldest known version that isn't older than its expiry version, or `None` if there is no such version. Both are `None` for histograms that never expire."""
     # check if the histogram expires or not
     expiry_version = histogram_entry.get("expires_in_version", "never").strip()
-    if expiry_version in {"never", "default"}: return False
+    if expiry_version in {"never", "default"}: return None, None
 
     # check if the expiration version has a known release date
     expiry_version = version_normalize_nightly(expiry_version) # normalize the version to the nearest nightly if not specified
     if expiry_version in release_dates:
-        return release_dates[expiry_version] <= target_date if include_past else release_dates[expiry_version] == target_date
+        return release_dates[expiry_version], release_dates[expiry_version]
 
-    if include_past: # search for the oldest version that is greater than the current version and assume that is the release date
-        sorted_versions = sorted(release_dates.keys(), cmp=version_compare)
-        for version in sorted_versions:
-            if version_compare(expiry_version, version) <= 0:
-                return release_dates[version] <= target_date
+    # search for the oldest version that is greater than the current version and assume that is the release date
+    return None, release_dates.get_first_release_date(expiry_version)
 
-    return False # version expires in an unknown future or past version
+def is_expiring(histogram_entry, target_date, release_dates, include_past = False):
+    """Returns `True` if the histogram `histogram_entry` is expiring on the date `target_date`, `False` otherwise. `release_dates` is a `ReleaseCalendar`, or a dictionary mapping version numbers to their release dates."""
+    if not isinstance(release_dates, ReleaseCalendar): release_dates = ReleaseCalendar(release_dates)
+    release_date, estimated_release_date = get_expiry_date(histogram_entry, release_dates)
+    if include_past:
+        return estimated_release_date is not None and estimated_release_date <= target_date
+    return release_date == target_date # versions that expire in an unknown future or past version never match
 
 def replace_entries(entry):
     """Makes Scalars definitions contain same entries as Histograms"""
@@ -172,14 +408,54 @@ def replace_entries(entry):
     entry["alert_emails"] = entry.get("alert_emails", entry.get("notification_emails", []))
     return entry
 
+def classify_histograms(histograms, release_dates, target_dates, expired_date = None, catch_up = timedelta(days=1)):
+    """Sorts the histograms in `histograms` by when they expire, in a single pass over them.
+
+Returns a pair `(EXPIRING, EXPIRED)`, where `EXPIRING` maps each date in `target_dates` to a list of pairs containing the names and entries of the histograms that are expiring within `catch_up` up to that date (by default, on that date), and `EXPIRED` is a list of pairs for the histograms that have expired as of `expired_date` (or an empty list if `expired_date` is `None`). All the lists are sorted alphabetically by name."""
+    if not isinstance(release_dates, ReleaseCalendar): release_dates = ReleaseCalendar(release_dates)
+    expiring = {target_date: [] for target_date in target_dates}
+    expired = []
+    for name, entry in sorted(histograms.items(), key=lambda h: h[0]):
+        entry = replace_entries(entry)
+        release_date, estimated_release_date = get_expiry_date(entry, release_dates)
+        if release_date is not None:
+            for target_date, target_histograms in expiring.items():
+                if target_date - catch_up < release_date <= target_date:
+                    target_histograms.append((name, entry))
+        if expired_date is not None and estimated_release_date is not None and estimated_release_date <= expired_date:
+            expired.append((name, entry))
+    return expiring, expired
+
 def get_expiring_histograms(target_date, release_dates, histograms, include_past = False):
     """Returns a list of pairs containing histogram names and histogram entries that are expiring, sorted alphabetically by name."""
-    return sorted([
-        (name, replace_entries(entry)) for name, entry in histograms.items() if is_expiring(replace_entries(entry), target_date, release_dates, include_past=include_past)
-    ], key=lambda h: h[0])
-
-def run_tests():
-    assert len(get_release_dates()) > 4 # this function should return several versions if the table is formatted correctly
+    if include_past:
+        return classify_histograms(histograms, release_dates, [], target_date)[1]
+    return classify_histograms(histograms, release_dates, [target_date])[0][target_date]
+
+def run_tests(live = False):
+    if live: # check that the release calendar on the Mozilla Wiki can still be parsed, bypassing the cache
+        assert len(get_release_dates(cache_file = None)) > 4 # this function should return at least a few versions if the page is formatted correctly
+
+    release_dates = get_release_dates(RELEASE_CALENDAR_FIXTURE)
+    assert len(release_dates) == 25 # this function should return every version in the tables if they are formatted correctly
+    assert release_dates["44.0"] == date(2016, 1, 26) # from the past branch dates
+    assert release_dates["47.0"] == date(2016, 6, 7) # from the future branch dates, with a tentative date
+    assert release_dates["51.0a1"] == date(2016, 8, 1) and "48.0" not in release_dates # unknown release date
+    with open(RELEASE_CALENDAR_FIXTURE) as f:
+        calendar_html = f.read()
+    assert get_calendar_dates(re.sub(r"</(td|th|tr)>", "", calendar_html)) == release_dates # end tags that HTML allows to be omitted
+    try:
+        get_calendar_dates(re.sub(r"<table.*?</table>", "", calendar_html, flags=re.DOTALL))
+        assert False, "a release calendar without version tables should be rejected"
+    except ValueError: pass
+
+    cache_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
+    try:
+        write_release_dates_cache(cache_file, 1, release_dates)
+        assert get_release_dates(cache_file=cache_file) == release_dates # a fresh cache is used without accessing the network
+        assert read_release_dates_cache(cache_file)[1:] == (1, release_dates)
+    finally:
+        os.remove(cache_file)
 
     release_dates1 = {
       "38.0a1": date(2015, 6, 2),
@@ -229,6 +505,40 @@ def run_tests():
     assert get_expiring_histograms(date(2015, 11, 3), release_dates2, histograms, True) == [("a", {"alert_emails": [], "expires_in_version": "40"}), ("b", {"alert_emails": [], "expires_in_version": "40"}), ("c", {"alert_emails": [], "expires_in_version": "40.5"}), ("f", {"alert_emails": [], "expires_in_version": "42"}), ("i", {"alert_emails": [], "expires_in_version": "38"})]
     assert get_expiring_histograms(date(2015, 11, 4), release_dates2, histograms, True) == [("a", {"alert_emails": [], "expires_in_version": "40"}), ("b", {"alert_emails": [], "expires_in_version": "40"}), ("c", {"alert_emails": [], "expires_in_version": "40.5"}), ("f", {"alert_emails": [], "expires_in_version": "42"}), ("i", {"alert_emails": [], "expires_in_version": "38"})]
 
+    calendar = ReleaseCalendar(release_dates1)
+    assert calendar.get_first_release_date("37.0a1") == date(2015, 6, 2)
+    assert calendar.get_first_release_date("40.0a1") == date(2015, 8, 11)
+    assert calendar.get_first_release_date("40.5") == date(2015, 9, 22)
+    assert calendar.get_first_release_date("47.0a2") is None
+    assert get_expiring_histograms(date(2015, 11, 4), ReleaseCalendar(release_dates2), histograms, True) == get_expiring_histograms(date(2015, 11, 4), release_dates2, histograms, True)
+
+    assert classify_histograms(histograms, release_dates1, [date(2015, 8, 12), date(2015, 8, 10)], catch_up=timedelta(days=3))[0] == {
+        date(2015, 8, 12): [("a", {"alert_emails": [], "expires_in_version": "40"}), ("b", {"alert_emails": [], "expires_in_version": "40"})],
+        date(2015, 8, 10): [],
+    }
+
+    entries = [("a", {"expires_in_version": "40", "alert_emails": ["x@moz"], "description": "A"}), ("b", {"expires_in_version": "40", "alert_emails": ["x@moz", "y@moz"], "description": "B"})]
+    mail_dir = tempfile.mkdtemp()
+    stdout, sys.stdout = sys.stdout, StringIO() # don't print the test emails
+    try:
+        mailer = Mailer(FileBackend(mail_dir))
+        results = email_histogram_subscribers(date(2015, 7, 1), date(2015, 8, 11), entries, [], mailer = mailer)
+        assert sorted(results) == [(GENERAL_TELEMETRY_ALERT, ["a", "b"], ""), ("x@moz", ["a", "b"], ""), ("y@moz", ["b"], "")]
+        notified = {(name, email) for email, names, error in results for name in names if email != "x@moz"}
+        assert email_histogram_subscribers(date(2015, 7, 1), date(2015, 8, 11), entries, [], mailer = mailer, notified = notified) == [("x@moz", ["a", "b"], "")]
+        assert len(os.listdir(mail_dir)) == 4
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(mail_dir)
+
+    expiring, expired = classify_histograms(histograms, release_dates2, [date(2015, 11, 3), date(2015, 12, 15), date(2015, 11, 4)], date(2015, 11, 3))
+    assert expiring == {
+        date(2015, 11, 3): get_expiring_histograms(date(2015, 11, 3), release_dates2, histograms),
+        date(2015, 12, 15): get_expiring_histograms(date(2015, 12, 15), release_dates2, histograms),
+        date(2015, 11, 4): [],
+    }
+    assert expired == get_expiring_histograms(date(2015, 11, 3), release_dates2, histograms, True)
+
     assert get_expiring_histograms(date(2015, 8, 10), release_dates1, scalars) == []
     assert get_expiring_histograms(date(2015, 8, 11), release_dates1, scalars) == [("a", {"expires": "40", "notification_emails": ["test@moz"], "expires_in_version": "40", "alert_emails": ["test@moz"]})]
 
@@ -240,13 +550,19 @@ def print_help():
     print "Usage: {} list|email|test".format(sys.argv[0])
     print "  {} preview [YYYY-MM-DD] output notification messages for histograms that are soon expiring as of YYYY-MM-DD (defaults to current date)".format(sys.argv[0])
     print "  {} email [YYYY-MM-DD]   notify users of histograms that are soon expiring as of YYYY-MM-DD (defaults to current date)".format(sys.argv[0])
-    print "  {} test                 run various internal tests".format(sys.argv[0])
+    print "  {} test [--live]        run various internal tests, and check the release calendar on the Mozilla Wiki if --live is given".format(sys.argv[0])
+    print "The release calendar is read from the file named by the RELEASE_CALENDAR_FILE environment variable if set (HTML or wiki API JSON), otherwise from the Mozilla Wiki, cached in {}.".format(RELEASE_DATES_CACHE)
+    print "Emails are sent with Amazon SES, unless MAIL_OUTPUT_DIR is set to write them to files in that directory, or SMTP_SERVER is set to HOST[:PORT] to send them to that SMTP server."
 
 def main():
     if not (2 <= len(sys.argv) <= 3) or sys.argv[1] not in {"preview", "email", "test"}:
         print_help()
         sys.exit(1)
-    if sys.argv[1] == "test": run_tests()
+    if sys.argv[1] == "test":
+        if len(sys.argv) >= 3 and sys.argv[2] != "--live":
+            print_help()
+            sys.exit(1)
+        run_tests(live = len(sys.argv) >= 3)
 
     # get the reference date
     now = date.today()
@@ -268,17 +584,33 @@ def main():
 
     probes = dict(histograms.items() + scalars.items())
 
-    release_dates = get_release_dates()
-    target_date, target_date_sheriff = now + EMAIL_TIME_BEFORE, now + EMAIL_TIME_BEFORE_SHERIFF
-    notifiable_histograms = get_expiring_histograms(target_date, release_dates, probes) # histograms that we should send out notifications for
-    notifiable_histograms_sheriff = get_expiring_histograms(target_date_sheriff, release_dates, probes) # same as above, but sheriffs should also be notified
-    expired_histograms = get_expiring_histograms(now, release_dates, probes, include_past=True)
-    if sys.argv[1] == "preview": # dry run, just print out the emails rather than sending them
-        email_histogram_subscribers(now, target_date, notifiable_histograms, expired_histograms, dry_run = True)
-        email_histogram_subscribers(now, target_date_sheriff, notifiable_histograms_sheriff, expired_histograms, notify_sheriffs = True, dry_run = True)
-    else: # send out emails
-        email_histogram_subscribers(now, target_date, notifiable_histograms, expired_histograms)
-        email_histogram_subscribers(now, target_date_sheriff, notifiable_histograms_sheriff, expired_histograms, notify_sheriffs = True)
+    release_dates = ReleaseCalendar(get_release_dates(os.environ.get("RELEASE_CALENDAR_FILE")))
+    target_dates = [now + time_before for time_before, notify_sheriffs in NOTIFICATION_HORIZONS]
+    notifiable_histograms, expired_histograms = classify_histograms(probes, release_dates, target_dates, now, NOTIFICATION_CATCH_UP) # histograms that we should send out notifications for, by target date
+    first_run = not os.path.exists(NOTIFICATION_LEDGER)
+    ledger = read_notification_ledger(NOTIFICATION_LEDGER)
+    mailer = get_mailer()
+    dry_run = sys.argv[1] == "preview" # when previewing, just print out the emails rather than sending them
+    for target_date, (time_before, notify_sheriffs) in zip(target_dates, NOTIFICATION_HORIZONS):
+        # histograms whose notifications were missed on previous days are notified along with their release date
+        histograms_by_release_date = {}
+        for name, entry in notifiable_histograms[target_date]:
+            histograms_by_release_date.setdefault(get_expiry_date(entry, release_dates)[0], []).append((name, entry))
+
+        for release_date, histograms in sorted(histograms_by_release_date.items()):
+            notification = (time_before.days, release_date.isoformat())
+            if first_run and release_date < target_date:
+                # without a ledger, the notifications that were due before today were already sent on the day they were due, so they're only recorded
+                ledger.update((name, time_before.days, email, release_date.isoformat()) for name, entry in histograms for email in get_notification_emails(entry, notify_sheriffs))
+                if not dry_run:
+                    write_notification_ledger(NOTIFICATION_LEDGER, ledger)
+                continue
+            notified = {(name, email) for name, days_before, email, notified_release_date in ledger if (days_before, notified_release_date) == notification}
+            results = email_histogram_subscribers(now, release_date, histograms, expired_histograms, notify_sheriffs = notify_sheriffs, dry_run = dry_run, mailer = mailer, notified = notified)
+            sent = [(name, time_before.days, email, release_date.isoformat()) for email, histogram_names, error in results if not error for name in histogram_names]
+            if sent and not dry_run: # recorded after each batch, so that a run that fails later doesn't send this batch again when rerun
+                ledger.update(sent)
+                write_notification_ledger(NOTIFICATION_LEDGER, ledger)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Local stand-in for the Medusa endpoints used by poster.py, for testing and
+# benchmarking alert posting without a Medusa deployment.
+
+import simplejson as json
+import argparse
+import collections
+import gzip
+import random
+import re
+import StringIO
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import poster
+
+DETECTORS_PATH = re.compile(r"^/detectors/$")
+METRICS_PATH = re.compile(r"^/detectors/(\d+)/metrics/$")
+ALERTS_PATH = re.compile(r"^/detectors/(\d+)/metrics/(\d+)/alerts/$")
+
+class FakeMedusa(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Server for the Medusa detector, metric and alert endpoints on port `port`, keeping everything in memory. Each request is delayed by `latency` seconds, and each alert post fails with a 503 error with probability `error_rate`. Other errors can be injected with the `errors` and `rejected_metrics` attributes."""
+    daemon_threads = True
+
+    def __init__(self, port=8080, latency=0, error_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), FakeMedusaHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.detectors = {}             # detector names by ID
+        self.metrics = {}               # pairs (DETECTOR_ID, METRIC_NAME) by metric ID
+        self.alerts = set()             # pairs (METRIC_ID, DATE) of posted alerts
+        self.requests = collections.Counter() # number of requests by method and endpoint
+        self.errors = {}                # status codes to fail every request to an endpoint ("detectors", "metrics" or "alerts") with
+        self.rejected_metrics = set()   # names of the metrics whose alert posts are rejected with a 400 error
+        self.request_bytes = 0
+
+    def get_url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def handle_request_data(self, method, path, query, body):
+        """Returns a pair `(STATUS, RESPONSE)` for a request to the endpoint `path`, where `query` holds the query parameters and `body` is the decoded JSON body, if any."""
+        with self.lock:
+            match = DETECTORS_PATH.match(path)
+            if match:
+                self.requests[method + " detectors"] += 1
+                if "detectors" in self.errors:
+                    return self.errors["detectors"], {'error': "Injected error"}
+                if method == "GET":
+                    found = [{'id': id, 'name': name} for id, name in self.detectors.items() if name == query.get('name')]
+                    return (200, found) if found else (404, [])
+                id = len(self.detectors) + 1
+                self.detectors[id] = body['name']
+                return 201, {'id': id}
+
+            match = METRICS_PATH.match(path)
+            if match:
+                self.requests[method + " metrics"] += 1
+                if "metrics" in self.errors:
+                    return self.errors["metrics"], {'error': "Injected error"}
+                detector_id = int(match.group(1))
+                if detector_id not in self.detectors:
+                    return 404, {}
+                if method == "GET":
+                    found = [{'id': id, 'name': name} for id, (detector, name) in self.metrics.items() if detector == detector_id and name == query.get('name')]
+                    return (200, found) if found else (404, [])
+                id = len(self.metrics) + 1
+                self.metrics[id] = (detector_id, body['name'])
+                return 201, {'id': id}
+
+            match = ALERTS_PATH.match(path)
+            if match and method == "POST":
+                self.requests[method + " alerts"] += 1
+                detector_id, metric_id = int(match.group(1)), int(match.group(2))
+                if self.metrics.get(metric_id, (None, None))[0] != detector_id:
+                    return 404, {}
+                if "alerts" in self.errors:
+                    return self.errors["alerts"], {'error': "Injected error"}
+                if random.random() < self.error_rate:
+                    return 503, {'error': "Injected error"}
+                if self.metrics[metric_id][1] in self.rejected_metrics:
+                    return 400, {'error': "Injected rejection"}
+                if (metric_id, body['date']) in self.alerts:
+                    return 422, {'error': "Alert already exists"}
+                self.alerts.add((metric_id, body['date']))
+                return 201, {'id': len(self.alerts)}
+
+            self.requests[method + " other"] += 1
+            return 404, {}
+
+class FakeMedusaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep connections alive, like the real server
+    wbufsize = -1                   # send each response in one piece rather than a packet per header
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def handle_method(self, method):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.request_bytes += len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+
+        time.sleep(self.server.latency)
+        status, response = self.server.handle_request_data(method, url.path, query, json.loads(body) if body else None)
+
+        response = json.dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_alerts(detector, metric_count, alert_count, bucket_count):
+    """Returns `metric_count` metrics of the detector `detector`, and `alert_count` alerts for them with payloads like those of post.py, spread over a few dates."""
+    metrics = [poster.Metric("METRIC_{}".format(i), "Benchmark metric {}".format(i), detector) for i in range(metric_count)]
+    alerts = []
+    for i in range(alert_count):
+        metric = metrics[i % metric_count]
+        date = "2016-01-{:02d}".format(i // metric_count + 1)
+        series = [random.random() if 10 <= bucket < 30 else 0.0 for bucket in range(bucket_count)]
+        payload = {'reference_series': series, 'series': list(reversed(series)), 'buckets': range(bucket_count),
+                   'series_label': date, 'reference_series_label': 'Previous build-id',
+                   'x_label': metric.descr, 'y_label': "Normalized Frequency Count", 'title': metric.name,
+                   'link': "http://example.com/", 'type': 'graph'}
+        alerts.append((metric, payload, "", date))
+    return metrics, alerts
+
+def benchmark():
+    server = FakeMedusa(args.port, args.latency, args.error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    poster.set_server_url(server.get_url(), max_connections=args.jobs, compress=args.compress)
+
+    detector = poster.Detector("Benchmark Detector", "Benchmark Detector")
+    metrics, alerts = make_alerts(detector, args.metrics, args.alerts, args.buckets)
+    for label in ["First run", "Second run"]:
+        # a second run with the IDs now cached and every alert already submitted shows the steady-state request volume
+        server.requests.clear()
+        server.request_bytes = 0
+        for metric in metrics:
+            metric.__dict__.pop("id", None)
+        start = time.time()
+        realize_failures = poster.realize_metrics(detector, metrics, args.jobs)
+        posted, duplicates, failures = poster.post_alerts(detector, alerts, args.jobs, args.compact)
+        elapsed = time.time() - start
+
+        request_count = sum(server.requests.values())
+        print "{}: {:.2f}s, {} requests ({:.1f}/s), {} bytes sent".format(label, elapsed, request_count, request_count / elapsed, server.request_bytes)
+        print "  {} metrics not realized, {} alerts posted, {} already submitted, {} failed".format(len(realize_failures), len(posted), len(duplicates), len(failures))
+        for kind, count in sorted(server.requests.items()):
+            print "  {}: {}".format(kind, count)
+    poster.connections.close()
+    server.shutdown()
+    server.server_close()
+
+def serve():
+    server = FakeMedusa(args.port, args.latency, args.error_rate)
+    print "Serving a fake Medusa at " + server.get_url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for kind, count in sorted(server.requests.items()):
+        print "{}: {}".format(kind, count)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Medusa server for testing and benchmarking alert posting",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", choices=["serve", "benchmark"],
+                        help="Serve until interrupted, or post synthetic alerts to a temporary server and report the throughput")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port to listen on (0 picks a free port)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds to delay each response by")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of alert posts to fail with a 503 error")
+    parser.add_argument("--metrics", type=int, default=1000,
+                        help="Number of metrics to realize when benchmarking")
+    parser.add_argument("--alerts", type=int, default=200,
+                        help="Number of alerts to post when benchmarking")
+    parser.add_argument("--buckets", type=int, default=100,
+                        help="Number of buckets in each benchmark alert")
+    parser.add_argument("-j", "--jobs", type=int, default=poster.MAX_CONNECTIONS,
+                        help="Maximum number of requests in flight when benchmarking")
+    parser.add_argument("--compact", action="store_true",
+                        help="Post compact alert payloads when benchmarking")
+    parser.add_argument("--compress", action="store_true",
+                        help="Gzip request bodies when benchmarking")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve()
+    else:
+        benchmark()
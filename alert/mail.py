@@ -2,25 +2,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import re
+import smtplib
+import tempfile
+import threading
+import time
 import boto
+import boto.exception
+from multiprocessing.pool import ThreadPool
 
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-def send_ses(fromaddr,
-             subject,
-             body,
-             recipient,
-             filename=''):
-    """Send an email via the Amazon SES service.
+MAX_WORKERS = 4             # Maximum number of emails being sent at once
+MAX_SENDS_PER_SECOND = 14   # Maximum number of emails sent per second, the default Amazon SES sending rate
 
-Example:
-  send_ses('me@example.com, 'greetings', "Hi!", 'you@example.com)
+default_mailer = None
 
-Return:
-  If 'ErrorResponse' appears in the return message from SES,
-  return the message, otherwise return an empty '' string."""
+def make_message(fromaddr, subject, body, recipient, filename=''):
     msg = MIMEMultipart()
     msg['Subject'] = subject
     msg['From'] = fromaddr
@@ -32,8 +33,110 @@ Return:
         part = MIMEApplication(attachment)
         part.add_header('Content-Disposition', 'attachment', filename=filename)
         msg.attach(part)
+    return msg.as_string()
+
+class SESBackend:
+    """Sends emails via the Amazon SES service, over a single connection that is opened on the first send."""
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def send(self, fromaddr, recipient, message):
+        with self.lock:
+            if self.connection is None:
+                self.connection = boto.connect_ses()
+        result = self.connection.send_raw_email(message)
+        return result if 'ErrorResponse' in result else ''
+
+class SMTPBackend:
+    """Sends emails to the SMTP server at `host` and `port`, over a single connection."""
+    def __init__(self, host='localhost', port=25):
+        self.host = host
+        self.port = port
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def send(self, fromaddr, recipient, message):
+        with self.lock: # SMTP connections can only send one email at a time
+            if self.connection is not None:
+                try:
+                    self.connection.sendmail(fromaddr, [recipient], message)
+                    return ''
+                except smtplib.SMTPServerDisconnected: # the server closed the connection since the last email
+                    self.connection = None
+            self.connection = smtplib.SMTP(self.host, self.port)
+            self.connection.sendmail(fromaddr, [recipient], message)
+        return ''
+
+class FileBackend:
+    """Writes emails to files in the directory `directory` instead of sending them, one file per email."""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def send(self, fromaddr, recipient, message):
+        prefix = time.strftime("%Y%m%dT%H%M%S-") + re.sub(r"[^\w.@-]", "_", recipient) + "-"
+        descriptor, path = tempfile.mkstemp(suffix=".eml", prefix=prefix, dir=self.directory) # unique even across runs
+        with os.fdopen(descriptor, "w") as f:
+            f.write(message)
+        return ''
+
+class Mailer:
+    """Sends emails through `backend` (SES by default), with at most `max_workers` emails being sent at once, and at most `max_rate` emails sent per second."""
+    def __init__(self, backend=None, max_workers=MAX_WORKERS, max_rate=MAX_SENDS_PER_SECOND):
+        self.backend = backend if backend is not None else SESBackend()
+        self.max_workers = max_workers
+        self.interval = 1.0 / max_rate
+        self.next_send = 0
+        self.lock = threading.Lock()
 
-    conn = boto.connect_ses()
-    result = conn.send_raw_email(msg.as_string())
+    def wait_for_turn(self):
+        # sends are spaced evenly, so a burst of emails never goes over the rate
+        with self.lock:
+            now = time.time()
+            send_time = max(now, self.next_send)
+            self.next_send = send_time + self.interval
+        time.sleep(send_time - now)
 
-    return result if 'ErrorResponse' in result else ''
+    def send(self, fromaddr, subject, body, recipient, filename=''):
+        """Send an email, returning the error message from the backend, or an empty '' string if it was sent."""
+        message = make_message(fromaddr, subject, body, recipient, filename)
+        self.wait_for_turn()
+        return self.backend.send(fromaddr, recipient, message)
+
+    def send_all(self, emails):
+        """Send each email in `emails`, a list of tuples `(FROMADDR, SUBJECT, BODY, RECIPIENT)`.
+
+Returns a list of pairs `(RECIPIENT, ERROR)` in the same order, where `ERROR` is an empty '' string for emails that were sent."""
+        def send_email(email):
+            fromaddr, subject, body, recipient = email
+            try:
+                return recipient, self.send(fromaddr, subject, body, recipient)
+            except (boto.exception.BotoServerError, boto.exception.BotoClientError, smtplib.SMTPException, EnvironmentError) as e:
+                return recipient, str(e) or repr(e)
+
+        pool = ThreadPool(self.max_workers)
+        try:
+            return pool.map(send_email, emails)
+        finally:
+            pool.close()
+            pool.join()
+
+def send_ses(fromaddr,
+             subject,
+             body,
+             recipient,
+             filename=''):
+    """Send an email via the Amazon SES service, reusing the same connection for every call.
+
+Example:
+  send_ses('me@example.com, 'greetings', "Hi!", 'you@example.com)
+
+Return:
+  If 'ErrorResponse' appears in the return message from SES,
+  return the message, otherwise return an empty '' string."""
+    global default_mailer
+    if default_mailer is None:
+        default_mailer = Mailer()
+    return default_mailer.send(fromaddr, subject, body, recipient, filename)
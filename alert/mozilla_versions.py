@@ -1,9 +1,12 @@
 import re
 
+PART_PATTERN = re.compile("(-?\d+)(?:(\D+)(?:(-?\d+)(?:(\D+))?)?)?")
+PARSE_CACHE_SIZE = 1 << 14 # maximum number of parsed versions kept by `Version.parse`
+
 def parse_part(part):
     if part is None or part == "": return (0, None, 0, None)
     if part == "*": return (float("inf"),)
-    match = re.match("(-?\d+)(?:(\D+)(?:(-?\d+)(?:(\D+))?)?)?", part)
+    match = PART_PATTERN.match(part)
     components = list(match.groups())
     components[2] = int(components[2]) if components[2] is not None else 0
     if components[1] == "+":
@@ -28,13 +31,74 @@ def part_to_string(part):
                 part_string += part[3]
     return part_string
 
+def part_sort_key(parsed_part):
+    # missing components sort after present ones, as in `part_compare`
+    return tuple((1,) if component is None else (0, component) for component in parsed_part)
+
+EMPTY_PART_KEY = part_sort_key(parse_part(None))
+
+class Version(object):
+    """A version number, parsed once into its parts and a sort key, and compared by that key with the same results as `version_compare`.
+
+`Version.parse` should be used rather than the constructor, as it reuses the parsed versions."""
+    __slots__ = ("string", "parts", "key")
+    cache = {}
+
+    def __init__(self, string):
+        self.string = string
+        self.parts = tuple(parse_part(part) for part in string.strip().split("."))
+
+        # `version_compare` pads the shorter version with empty parts, so each part that isn't equivalent to an empty part is encoded
+        # along with whether it sorts before or after an empty part and the number of empty parts before it
+        tokens = []
+        empty_parts = 0
+        for part in self.parts:
+            part_key = part_sort_key(part)
+            if part_key == EMPTY_PART_KEY:
+                empty_parts += 1
+                continue
+            if part_key > EMPTY_PART_KEY: # a version with fewer empty parts before this one is greater
+                tokens.append((1, -empty_parts, part_key))
+            else: # a version with fewer empty parts before this one is smaller
+                tokens.append((-1, empty_parts, part_key))
+            empty_parts = 0
+        tokens.append((0,)) # the rest of the version is empty parts, which sorts between the two kinds of parts above
+        self.key = tuple(tokens)
+
+    @classmethod
+    def parse(cls, string):
+        """Returns the `Version` for `string`, reusing the one from a previous call if possible."""
+        version = cls.cache.get(string)
+        if version is None:
+            if len(cls.cache) >= PARSE_CACHE_SIZE: # keep the cache bounded, it fills up again with the versions still in use
+                cls.cache.clear()
+            version = cls.cache[string] = cls(string)
+        return version
+
+    # comparisons with other types are left to the other operand, or to the default comparison
+    def __eq__(self, other): return self.key == other.key if isinstance(other, Version) else NotImplemented
+    def __ne__(self, other): return self.key != other.key if isinstance(other, Version) else NotImplemented
+    def __lt__(self, other): return self.key < other.key if isinstance(other, Version) else NotImplemented
+    def __le__(self, other): return self.key <= other.key if isinstance(other, Version) else NotImplemented
+    def __gt__(self, other): return self.key > other.key if isinstance(other, Version) else NotImplemented
+    def __ge__(self, other): return self.key >= other.key if isinstance(other, Version) else NotImplemented
+    def __hash__(self): return hash(self.key)
+
+    def __str__(self):
+        return self.string
+
+    def __repr__(self):
+        return "Version({!r})".format(self.string)
+
 def version_compare(version1, version2):
-    for result in map(part_compare, version1.strip().split("."), version2.strip().split(".")):
-        if result != 0: return result
-    return 0
+    return cmp(Version.parse(version1).key, Version.parse(version2).key)
+
+def version_sort_key(version):
+    """Returns a key for `version` such that comparing the keys of two versions gives the same result as `version_compare`, for sorting and searching versions without a comparison function."""
+    return Version.parse(version).key
 
 def version_add_major(version, amount = 1):
-    version_parts = list(map(parse_part, version.strip().split(".")))
+    version_parts = list(Version.parse(version).parts)
     major = version_parts[0]
     version_parts[0] = (major[0] + amount, major[1], major[2], major[3])
     return ".".join(part_to_string(part) for part in version_parts)
@@ -44,7 +108,7 @@ def version_get_major(version):
     return parse_part(versions[-1].strip().split(".")[0])[0]
 
 def version_normalize_nightly(version):
-    version_parts = list(map(parse_part, version.strip().split(".")))
+    version_parts = list(Version.parse(version).parts)
     if len(version_parts) == 1: return version + ".0a1" # versions of the form N
     if len(version_parts) == 2:
         minor = version_parts[1]
@@ -80,6 +144,25 @@ if __name__ == "__main__":
     assert version_compare("1.10", "1.*") == -1
     assert version_compare("1.*", "1.*.1") == -1
     assert version_compare("1.*.1", "2.0") == -1
+    ordered_versions = ["1.-1", "1", "1.0.0", "1.1a", "1.1aa", "1.1ab", "1.1b", "1.1c", "1.1pre", "1.0+", "1.1pre1a", "1.1pre1aa", "1.1pre1b", "1.1pre1", "1.1pre2", "1.1pre10", "1.1.-1", "1.1", "1.1.00", "1.10", "1.*", "1.*.1", "2.0", "2.0.0.-1.1", "2.0.0.-1", "2.0.-1.1", "2.0.1.-1", "2.0.1", "2.0..1"]
+    def part_wise_compare(version1, version2): # comparing the parts one by one, padding the shorter version with empty parts
+        for result in map(part_compare, version1.strip().split("."), version2.strip().split(".")):
+            if result != 0: return result
+        return 0
+    import random
+    generator = random.Random(42)
+    parts = ["", "0", "00", "1", "-1", "2", "10", "*", "1a", "1b", "1aa", "1pre", "1pre1", "0+", "1pre1a", "2b3c"]
+    random_versions = [".".join(generator.choice(parts) for part in range(generator.randint(1, 4))) for version in range(300)]
+    for version1 in ordered_versions + random_versions:
+        for version2 in ordered_versions + random_versions[:50]:
+            assert cmp(version_sort_key(version1), version_sort_key(version2)) == part_wise_compare(version1, version2), (version1, version2)
+            assert version_compare(version1, version2) == part_wise_compare(version1, version2)
+    assert sorted(reversed(ordered_versions), key=Version.parse) == sorted(reversed(ordered_versions), cmp=version_compare)
+    assert Version.parse("42.0") is Version.parse("42.0")
+    assert Version.parse("42.0") == Version.parse("42") and hash(Version.parse("42.0")) == hash(Version.parse("42"))
+    assert Version.parse("42.0a1") < Version.parse("42.0") <= Version.parse("42.0.0") < Version.parse("42.1") != Version.parse("42")
+    assert str(Version.parse("42.0a1")) == "42.0a1"
+    assert Version.parse("42.0") != "42.0" and not (Version.parse("42.0") == "42.0") and Version.parse("42.0") not in [None, 42, "42.0"]
     assert version_add_major("42.0.1") == "43.0.1"
     assert version_add_major("42", 1000) == "1042"
     assert version_add_major("42.0") == "43.0"
@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Durable queue of alerts waiting to be posted to Medusa, which survives
+# failed deliveries and interrupted runs.
+
+import simplejson as json
+import collections
+import httplib
+import random
+import sqlite3
+import time
+
+import poster
+
+MAX_ATTEMPTS = 5            # Number of times to try posting each alert in a single delivery run
+INITIAL_BACKOFF = 2         # Seconds to wait before retrying failed alerts for the first time, doubled after each retry
+MAX_TOTAL_ATTEMPTS = 20     # Number of failed attempts over all delivery runs after which an alert is parked instead of retried
+
+class Outbox:
+    """Alerts waiting to be posted, stored in the SQLite database at `path`."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS alerts (
+            date TEXT, metric TEXT, description TEXT, payload TEXT, emails TEXT,
+            attempts INTEGER DEFAULT 0, last_error TEXT, parked INTEGER DEFAULT 0,
+            PRIMARY KEY (date, metric)
+        )""")
+        if "parked" not in [column[1] for column in self.db.execute("PRAGMA table_info(alerts)")]: # outboxes created before alerts could be parked
+            self.db.execute("ALTER TABLE alerts ADD COLUMN parked INTEGER DEFAULT 0")
+        self.db.commit()
+
+    def add(self, alerts):
+        """Queue each alert in `alerts`, a list of tuples `(METRIC, PAYLOAD, EMAILS, DATE)`, unless an alert for the same metric and date is already queued or parked."""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO alerts (date, metric, description, payload, emails) VALUES (?, ?, ?, ?, ?)",
+                [(date, metric.name, metric.descr, json.dumps(payload), emails) for metric, payload, emails, date in alerts]
+            )
+
+    def pending(self, detector):
+        """Returns the queued alerts that aren't parked as tuples `(METRIC, PAYLOAD, EMAILS, DATE)` with metrics of the detector `detector`, oldest first for each metric."""
+        return [alert for alert, attempts, last_error in self.select(detector, parked=False)]
+
+    def parked(self, detector):
+        """Returns the parked alerts, which are no longer retried, as tuples `(ALERT, ATTEMPTS, LAST_ERROR)`, where `ALERT` is as for `pending`."""
+        return self.select(detector, parked=True)
+
+    def select(self, detector, parked):
+        rows = self.db.execute("SELECT date, metric, description, payload, emails, attempts, last_error FROM alerts WHERE parked = ? ORDER BY date, metric", (int(parked),))
+        metrics = {}
+        alerts = []
+        for date, metric_name, description, payload, emails, attempts, last_error in rows:
+            if metric_name not in metrics:
+                metrics[metric_name] = poster.Metric(metric_name, description, detector)
+            alerts.append(((metrics[metric_name], json.loads(payload), emails, date), attempts, last_error))
+        return alerts
+
+    def remove(self, alerts):
+        with self.db:
+            self.db.executemany("DELETE FROM alerts WHERE date = ? AND metric = ?",
+                                [(date, metric.name) for metric, payload, emails, date in alerts])
+
+    def record_failures(self, failures):
+        with self.db:
+            self.db.executemany("UPDATE alerts SET attempts = attempts + 1, last_error = ? WHERE date = ? AND metric = ?",
+                                [(str(error), date, metric.name) for (metric, payload, emails, date), error in failures])
+
+    def park(self, alerts):
+        with self.db:
+            self.db.executemany("UPDATE alerts SET parked = 1 WHERE date = ? AND metric = ?",
+                                [(date, metric.name) for metric, payload, emails, date in alerts])
+
+    def out_of_attempts(self, alerts, max_total_attempts):
+        return [alert for alert in alerts if self.db.execute("SELECT attempts FROM alerts WHERE date = ? AND metric = ?",
+                                                             (alert[3], alert[0].name)).fetchone()[0] >= max_total_attempts]
+
+    def requeue_parked(self):
+        """Queue the parked alerts again, with their failed attempts forgotten, returning how many there were."""
+        with self.db:
+            return self.db.execute("UPDATE alerts SET parked = 0, attempts = 0, last_error = NULL WHERE parked = 1").rowcount
+
+    def deliver(self, detector, max_in_flight=poster.MAX_CONNECTIONS, max_attempts=MAX_ATTEMPTS, initial_backoff=INITIAL_BACKOFF, max_total_attempts=MAX_TOTAL_ATTEMPTS, compact=False):
+        """Post the queued alerts for the detector `detector`, with at most `max_in_flight` requests at once, and compact payloads if `compact` is set. Alerts that fail with an error that `poster.is_retryable` are retried with exponential backoff, up to `max_attempts` times in total, and are left in the queue if they still fail. Alerts that the server rejects (see `poster.is_rejection`), or that have failed `max_total_attempts` times over all runs, are parked: they stay in the outbox but aren't posted again until `requeue_parked` is called. If the detector can't be realized, the alerts stay queued without counting as failed attempts.
+
+Returns a tuple `(POSTED, DUPLICATES, FAILURES, PARKED)`, where `POSTED` and `DUPLICATES` are as for `poster.post_alerts`, `FAILURES` is a list of pairs `(ALERT, ERROR)` for the alerts that are still queued, and `PARKED` is a list of pairs `(ALERT, ERROR)` for the alerts parked by this run."""
+        delivered, duplicates, parked = [], [], []
+        failures = collections.OrderedDict() # pairs (ALERT, ERROR) for the alerts that failed and are still queued, by alert identity
+        alerts = self.pending(detector)
+        backoff = initial_backoff
+        for attempt in range(max_attempts):
+            if not alerts:
+                break
+            if attempt > 0:
+                time.sleep(backoff * random.uniform(1, 1.5)) # randomized so that retries from several runs don't stay in step
+                backoff *= 2
+
+            try:
+                posted, already_posted, attempt_failures = poster.post_alerts(detector, alerts, max_in_flight, compact)
+            except (EnvironmentError, httplib.HTTPException, ValueError) as e: # the detector couldn't be realized, so none of the alerts were attempted
+                failures.update((id(alert), (alert, e)) for alert in alerts)
+                if not poster.is_retryable(e):
+                    break
+                continue
+            self.remove(posted + already_posted)
+            self.record_failures(attempt_failures)
+            delivered += posted
+            duplicates += already_posted
+
+            # rejected alerts won't be accepted on a later attempt either, so they're parked along with those out of attempts
+            exhausted = set(id(alert) for alert in self.out_of_attempts([alert for alert, error in attempt_failures], max_total_attempts))
+            newly_parked = [(alert, error) for alert, error in attempt_failures if poster.is_rejection(error) or id(alert) in exhausted]
+            self.park([alert for alert, error in newly_parked])
+            parked += newly_parked
+
+            # other failures stay queued, but are only retried in this run if they might succeed soon
+            for alert in posted + already_posted + [alert for alert, error in newly_parked]:
+                failures.pop(id(alert), None)
+            retried = [(alert, error) for alert, error in attempt_failures if not poster.is_rejection(error) and id(alert) not in exhausted]
+            failures.update((id(alert), (alert, error)) for alert, error in retried)
+            alerts = [alert for alert, error in retried if poster.is_retryable(error)]
+        return delivered, duplicates, failures.values(), parked
+
+    def close(self):
+        self.db.close()
+
+def run_tests():
+    import os
+    import tempfile
+    import threading
+    import fake_medusa
+
+    server = fake_medusa.FakeMedusa(0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    poster.set_server_url(server.get_url(), timeout=5)
+    poster.id_cache = {"detectors": {}, "metrics": {}}
+    path = tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False).name
+    outbox = Outbox(path)
+    detector = poster.Detector("Test Detector", "Test Detector")
+    metrics, alerts = fake_medusa.make_alerts(detector, 3, 18, 10) # 3 metrics with 6 dates of alerts each
+    queued = lambda: len(outbox.pending(detector))
+    keys = lambda alerts: [(metric.name, date) for metric, payload, emails, date in alerts] # queued alerts have their own metric objects
+    try:
+        # alerts stay queued without counting as failed attempts if the detector can't be realized
+        server.errors = {"detectors": 403}
+        outbox.add(alerts[:6])
+        posted, duplicates, failures, parked = outbox.deliver(detector, initial_backoff=0)
+        assert (len(posted), len(failures), len(parked), queued()) == (0, 6, 0, 6)
+        assert all(attempts == 0 for alert, attempts, last_error in outbox.select(detector, parked=False))
+
+        # alerts are retried until they are posted, in order for each metric
+        server.errors = {}
+        server.error_rate = 0.5
+        posted, duplicates, failures, parked = outbox.deliver(detector, max_attempts=50, initial_backoff=0)
+        assert (len(posted), len(failures), len(parked), queued()) == (6, 0, 0, 0)
+        assert server.requests["POST alerts"] > 6 and len(server.alerts) == 6
+
+        # alerts that still fail after a delivery are posted by the next one
+        server.error_rate = 0
+        server.errors = {"alerts": 429}
+        outbox.add(alerts[6:12])
+        posted, duplicates, failures, parked = outbox.deliver(detector, max_attempts=2, initial_backoff=0)
+        assert (len(posted), len(failures), len(parked), queued()) == (0, 6, 0, 6)
+        server.errors = {}
+        posted, duplicates, failures, parked = outbox.deliver(detector, initial_backoff=0)
+        assert (len(posted), len(failures), len(parked), queued()) == (6, 0, 0, 0)
+        outbox.add(alerts[:6])
+        assert sorted(keys(outbox.deliver(detector, initial_backoff=0)[1])) == sorted(keys(alerts[:6])) # alerts that were already posted are reported as duplicates
+
+        # rejected alerts are parked without holding back the metric's later alerts, and stay parked until they are queued again
+        server.rejected_metrics = {"METRIC_1"}
+        outbox.add(alerts[12:])
+        posted, duplicates, failures, parked = outbox.deliver(detector, initial_backoff=0)
+        assert (len(posted), len(failures), len(parked), queued()) == (4, 0, 2, 0)
+        assert [alert[0].name for alert, attempts, last_error in outbox.parked(detector)] == ["METRIC_1", "METRIC_1"]
+        outbox.add([alert for alert in alerts[12:] if alert[0].name == "METRIC_1"])
+        assert queued() == 0
+        server.rejected_metrics = set()
+        assert outbox.requeue_parked() == 2
+        assert len(outbox.deliver(detector, initial_backoff=0)[0]) == 2
+
+        # alerts that keep failing are parked once they are out of attempts over all runs
+        server.errors = {"alerts": 503}
+        later_alerts = fake_medusa.make_alerts(detector, 1, 7, 10)[1][6:]
+        outbox.add(later_alerts)
+        assert outbox.deliver(detector, max_attempts=2, initial_backoff=0, max_total_attempts=3)[3] == []
+        assert keys(alert for alert, error in outbox.deliver(detector, max_attempts=2, initial_backoff=0, max_total_attempts=3)[3]) == keys(later_alerts)
+        assert [(alert[0].name, attempts) for alert, attempts, last_error in outbox.parked(detector)] == [("METRIC_0", 3)]
+    finally:
+        outbox.close()
+        os.remove(path)
+        poster.connections.close()
+        server.shutdown()
+        server.server_close()
+    print "All tests passed!"
+
+if __name__ == "__main__":
+    run_tests()
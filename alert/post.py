@@ -1,8 +1,24 @@
 import simplejson as json
+import argparse
+import os
 import poster
+from outbox import Outbox
+
+ID_CACHE_FILENAME = "medusa_ids.json"  # Path of JSON file caching the Medusa IDs of the detector and its metrics
+MAX_IN_FLIGHT = 8                      # Maximum number of requests to Medusa in progress at once
+LEDGER_FILENAME = "posted_alerts.json" # Path of JSON file listing the names of the histograms whose alerts were posted, by date
+OUTBOX_FILENAME = "outbox.sqlite"      # Path of SQLite database queuing the alerts that haven't been posted yet
+COMPACT_PAYLOADS = True                # Trim empty buckets from the ends of alert graphs and round their values
+COMPRESS_REQUESTS = False              # Gzip request bodies, which requires a Medusa server that accepts them
+
+parser = argparse.ArgumentParser(description="Post the detected regressions to Medusa")
+parser.add_argument("--requeue-parked", action="store_true",
+                    help="Queue the alerts that were parked in the outbox again, after the problem that caused them to be rejected has been fixed")
+args = parser.parse_args()
 
 detector = poster.Detector("Histogram Regression Detector", "Histogram Regression Detector")
-poster.set_server_url("http://localhost:8080")
+poster.set_server_url("http://localhost:8080", max_connections=MAX_IN_FLIGHT, compress=COMPRESS_REQUESTS)
+poster.load_id_cache(ID_CACHE_FILENAME)
 
 # Load list of histogram names for which alerts should not be sent
 try:
@@ -20,26 +36,64 @@ with open("Scalars.json") as f:
 
 probes = dict(histograms.items() + scalars.items())
 
-for name, description in probes.iteritems():
-    metric = poster.Metric(name, description['description'], detector)
-    metric.realize()
+# Load the alerts that were posted in previous runs
+try:
+    with open(LEDGER_FILENAME) as f:
+        posted_alerts = set((date, histogram_name) for date, histogram_names in json.load(f).iteritems() for histogram_name in histogram_names)
+except IOError:
+    posted_alerts = set()
 
-# Post detected alerts
+# Collect the newly detected alerts
 with open('dashboard/regressions.json') as f:
     regressions = json.load(f)
 
-    for date, regressions in regressions.iteritems():
-        for histogram_name, regression in regressions.iteritems():
-            if histogram_name not in ignored_histogram_names:
-                metric = poster.Metric(histogram_name, regression['description'], detector)
-                payload = {'reference_series': regression['reference'],
-                           'series': regression['regression'],
-                           'buckets': regression['buckets'],
-                           'series_label': date,
-                           'reference_series_label': 'Previous build-id',
-                           'x_label': regression['description'],
-                           'y_label': "Normalized Frequency Count",
-                           'title': histogram_name,
-                           'link': "http://telemetry.mozilla.org/new-pipeline/dist.html#!measure={histogram_name}&product=Firefox&start_date={date}&end_date={date}&table=0&use_submission_date=0".format(date=date, histogram_name=histogram_name),
-                           'type': 'graph'}
-                poster.post_alert(detector, metric, payload, ",".join(regression['alert_emails']), date)
+alerts = []
+for date, regressions in sorted(regressions.iteritems()):
+    for histogram_name, regression in regressions.iteritems():
+        if histogram_name not in ignored_histogram_names and (date, histogram_name) not in posted_alerts:
+            metric = poster.Metric(histogram_name, regression['description'], detector)
+            payload = {'reference_series': regression['reference'],
+                       'series': regression['regression'],
+                       'buckets': regression['buckets'],
+                       'series_label': date,
+                       'reference_series_label': 'Previous build-id',
+                       'x_label': regression['description'],
+                       'y_label': "Normalized Frequency Count",
+                       'title': histogram_name,
+                       'link': "http://telemetry.mozilla.org/new-pipeline/dist.html#!measure={histogram_name}&product=Firefox&start_date={date}&end_date={date}&table=0&use_submission_date=0".format(date=date, histogram_name=histogram_name),
+                       'type': 'graph'}
+            alerts.append((metric, payload, ",".join(regression['alert_emails']), date))
+
+# Queue the new alerts before making any requests, so that they are delivered by a later run if this one fails
+outbox = Outbox(OUTBOX_FILENAME)
+outbox.add(alerts)
+if args.requeue_parked:
+    print "Queued {} parked alerts again".format(outbox.requeue_parked())
+
+# Realize the metrics on the server, then deliver the queued alerts along with any left over from previous runs
+metrics = [poster.Metric(name, description['description'], detector) for name, description in probes.iteritems()]
+realize_failures = poster.realize_metrics(detector, metrics, MAX_IN_FLIGHT)
+poster.save_id_cache()
+posted, duplicates, failures, parked = outbox.deliver(detector, MAX_IN_FLIGHT, compact=COMPACT_PAYLOADS)
+outbox.close()
+poster.save_id_cache()
+
+# Record the posted alerts, including those that the server already had, so that they aren't sent again
+ledger = {}
+for date, histogram_name in posted_alerts.union((date, metric.name) for metric, payload, emails, date in posted + duplicates):
+    ledger.setdefault(date, []).append(histogram_name)
+with open(LEDGER_FILENAME + ".tmp", "w") as f:
+    json.dump({date: sorted(histogram_names) for date, histogram_names in ledger.iteritems()}, f, indent=2, sort_keys=True)
+os.rename(LEDGER_FILENAME + ".tmp", LEDGER_FILENAME)
+
+print "Posted {} alerts, {} had already been submitted, {} failed and are queued for the next run, {} were parked".format(len(posted), len(duplicates), len(failures), len(parked))
+if realize_failures:
+    print "{} metrics could not be realized and will be realized again when their alerts are posted, or by the next run".format(len(realize_failures))
+for metric, error in realize_failures:
+    print "Metric: " + metric.name + ", could not be realized: " + str(error)
+for metric, payload, emails, date in duplicates:
+    print "Alert for metric: " + metric.name + " on " + date + ", has already been submitted!"
+for (metric, payload, emails, date), error in failures:
+    print "Alert for metric: " + metric.name + " on " + date + ", could not be posted: " + str(error)
+for (metric, payload, emails, date), error in parked:
+    print "Alert for metric: " + metric.name + " on " + date + ", was parked and won't be retried until --requeue-parked is given: " + str(error)
@@ -1,25 +1,138 @@
 import simplejson as json
+import os
+import socket
 import urllib
 import urllib2
+import httplib
+import urlparse
+import threading
+import StringIO
+import gzip
+import itertools
+import collections
 import time
+from multiprocessing.pool import ThreadPool
+
+TIMEOUT = 30                # Seconds to wait for Medusa to respond to each request
+MAX_CONNECTIONS = 4         # Maximum number of simultaneous connections to the Medusa server
+PAYLOAD_PRECISION = 6       # Number of decimal places kept in the series values of compact alert payloads
 
 server = ""
+connections = None
+compress_requests = False
+id_cache = {"detectors": {}, "metrics": {}} # detector IDs by detector name, and metric IDs by detector ID and metric name
+id_cache_path = None
+
+class ConnectionPool:
+    """Persistent HTTP connections to the server at `url`, reused between requests. At most `max_connections` requests are made at once; other threads wait for a connection to become free."""
+    def __init__(self, url, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT):
+        parts = urlparse.urlsplit(url)
+        self.url = url
+        self.connection_class = httplib.HTTPSConnection if parts.scheme == "https" else httplib.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def request(self, method, uri, body=None, headers={}, timeout=None):
+        """Make a request to `uri` on the server and return the response body. Raises `urllib2.HTTPError` for error statuses, like `urllib2.urlopen` does."""
+        timeout = self.timeout if timeout is None else timeout
+        with self.slots:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            try:
+                if connection is None:
+                    connection = self.connection_class(self.host, timeout=timeout)
+                    response, data = self.send(connection, method, uri, body, headers, timeout)
+                else:
+                    try:
+                        response, data = self.send(connection, method, uri, body, headers, timeout)
+                    except socket.timeout:
+                        raise
+                    except (httplib.HTTPException, socket.error):
+                        # the server may have closed the connection while it was idle, so retry once on a new one
+                        connection.close()
+                        connection = self.connection_class(self.host, timeout=timeout)
+                        response, data = self.send(connection, method, uri, body, headers, timeout)
+            except:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                with self.lock:
+                    self.idle.append(connection)
 
-def GET(uri, params):
+        if response.status >= 400:
+            raise urllib2.HTTPError(self.url + uri, response.status, response.reason, response.msg, StringIO.StringIO(data))
+        return data
+
+    def send(self, connection, method, uri, body, headers, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request(method, self.path + uri, body, headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+def GET(uri, params, timeout=None):
     params = urllib.urlencode(params)
-    req = urllib2.Request(server + uri + "?" + params , headers={'Accept': 'application/json'})
-    return json.loads(urllib2.urlopen(req).read())
-
-def POST(uri, params):
-    params = json.dumps(params)
-    req = urllib2.Request(server + uri, params, headers={'Content-Type': 'application/json',
-                                                         'Accept': 'application/json'})
-    response = json.loads(urllib2.urlopen(req).read())
-    return response["id"]
-
-def set_server_url(url):
-    global server
+    response = connections.request("GET", uri + "?" + params, headers={'Accept': 'application/json'}, timeout=timeout)
+    return json.loads(response)
+
+def POST(uri, params, timeout=None):
+    params = json.dumps(params, separators=(',', ':'))
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    if compress_requests:
+        buffer = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+            f.write(params)
+        params = buffer.getvalue()
+        headers['Content-Encoding'] = 'gzip'
+    response = connections.request("POST", uri, params, headers=headers, timeout=timeout)
+    return json.loads(response)["id"]
+
+def set_server_url(url, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT, compress=False):
+    """Send all requests to the Medusa server at `url`, over at most `max_connections` persistent connections, waiting at most `timeout` seconds for each response. If `compress` is set, request bodies are sent gzipped, which the server must support."""
+    global server, connections, compress_requests
+    if connections is not None:
+        connections.close()
     server = url
+    compress_requests = compress
+    connections = ConnectionPool(url, max_connections, timeout)
+
+def load_id_cache(path):
+    """Cache detector and metric IDs in the file at `path`, so that they don't have to be looked up on the server again in later runs.
+
+Cached IDs are trusted until the server rejects them, so this must be called after `set_server_url`; IDs cached for a different server are discarded."""
+    global id_cache, id_cache_path
+    id_cache_path = path
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    if cache.get("server") != server:
+        cache = {}
+    id_cache = {"server": server, "detectors": cache.get("detectors", {}), "metrics": cache.get("metrics", {})}
+
+def save_id_cache():
+    """Store the cached detector and metric IDs in the file given to `load_id_cache`, if any."""
+    if id_cache_path is None:
+        return
+    temporary_path = id_cache_path + ".tmp" # written separately and moved into place, so an interrupted write doesn't leave a broken cache behind
+    with open(temporary_path, "w") as f:
+        json.dump(id_cache, f)
+    os.rename(temporary_path, id_cache_path)
 
 class Detector:
     def __init__(self, name, url):
@@ -30,14 +143,24 @@ class Detector:
         try:
             return self.id
         except AttributeError:
+            if self.name in id_cache["detectors"]:
+                self.id = id_cache["detectors"][self.name]
+                return self.id
+
             try:
                 detectors = GET("/detectors/", {'name': self.name})
                 self.id = detectors[0]['id']
             except urllib2.HTTPError as e:
                 self.id = POST("/detectors/", {'name': self.name, 'url': self.url})
 
+            id_cache["detectors"][self.name] = self.id
             return self.id
 
+    def forget_id(self):
+        """Forget the ID of the detector, including any cached one, so that it is looked up on the server again."""
+        self.__dict__.pop("id", None)
+        id_cache["detectors"].pop(self.name, None)
+
     def realize(self):
         self.get_id()
 
@@ -51,28 +174,143 @@ class Metric:
         try:
             return self.id
         except AttributeError:
-            uri = "/detectors/" + str(self.detector.get_id()) + "/metrics/"
+            detector_id = str(self.detector.get_id())
+            cached_ids = id_cache["metrics"].setdefault(detector_id, {})
+            if self.name in cached_ids:
+                self.id = cached_ids[self.name]
+                return self.id
 
+            uri = "/detectors/" + detector_id + "/metrics/"
             try:
                 metrics = GET(uri, {'name': self.name})
-                return metrics[0]['id']
+                self.id = metrics[0]['id']
             except urllib2.HTTPError as e:
-                return POST(uri, {'name': self.name, 'description': self.descr})
+                self.id = POST(uri, {'name': self.name, 'description': self.descr})
+
+            cached_ids[self.name] = self.id
+            return self.id
+
+    def forget_id(self):
+        """Forget the ID of the metric, including any cached one, so that it is looked up on the server again."""
+        self.__dict__.pop("id", None)
+        for cached_ids in id_cache["metrics"].values():
+            cached_ids.pop(self.name, None)
 
     def realize(self):
         self.get_id()
 
-def post_alert(detector, metric, payload, emails="", date=time.strftime("%Y-%m-%d")):
-    try:
+def compact_payload(payload, precision=PAYLOAD_PRECISION):
+    """Returns a copy of the graph alert payload `payload` without the leading and trailing buckets that are empty in both series, and with the series values rounded to `precision` decimal places. The result is still a valid graph payload."""
+    reference, series = payload['reference_series'], payload['series']
+    nonempty = [i for i in range(len(series)) if reference[i] or series[i]]
+    start, end = (nonempty[0], nonempty[-1] + 1) if nonempty else (0, 0)
+    payload = dict(payload)
+    payload['reference_series'] = [round(value, precision) for value in reference[start:end]]
+    payload['series'] = [round(value, precision) for value in series[start:end]]
+    payload['buckets'] = payload['buckets'][start:end]
+    return payload
+
+def submit_alert(detector, metric, payload, emails="", date=time.strftime("%Y-%m-%d"), compact=False):
+    """Post an alert for `metric`, raising `urllib2.HTTPError` if the server rejects it. If `compact` is set, the payload is trimmed and rounded with `compact_payload`."""
+    if compact:
+        payload = json.dumps(compact_payload(payload), separators=(',', ':'))
+    else:
         payload = json.dumps(payload)
+    try:
         uri = "/detectors/" + str(detector.get_id()) + "/metrics/" + str(metric.get_id()) + "/alerts/"
         return POST(uri, {'description': payload, 'date': date, 'emails': emails})
+    except urllib2.HTTPError as e:
+        if e.code != 404:
+            raise
+        # the detector or metric no longer exists under its cached ID, look both up again and retry
+        detector.forget_id()
+        metric.forget_id()
+        uri = "/detectors/" + str(detector.get_id()) + "/metrics/" + str(metric.get_id()) + "/alerts/"
+        return POST(uri, {'description': payload, 'date': date, 'emails': emails})
+
+def post_alert(detector, metric, payload, emails="", date=time.strftime("%Y-%m-%d"), compact=False):
+    try:
+        return submit_alert(detector, metric, payload, emails, date, compact)
     except urllib2.HTTPError as e:
         if e.code == 422:
             print "Alert for detector: " + detector.name + ", metric: " + metric.name + ", has already been submitted!"
         else:
             raise e
 
+def is_retryable(error):
+    """Whether a request that failed with `error` may succeed if it is made again soon. Server errors, timeouts, rate limiting and connection errors are temporary, while other errors are not."""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code in {408, 429}
+    return isinstance(error, (EnvironmentError, httplib.HTTPException))
+
+def is_rejection(error):
+    """Whether `error` is the server refusing an alert that was posted to it, so that posting the same alert again would fail the same way. Failures to look up the detector or the metric of the alert are not rejections."""
+    return isinstance(error, urllib2.HTTPError) and 400 <= error.code < 500 and not is_retryable(error) and error.filename.endswith("/alerts/")
+
+def realize_metrics(detector, metrics, max_in_flight=MAX_CONNECTIONS):
+    """Realize each metric in `metrics` on the server, with at most `max_in_flight` requests at once.
+
+Returns a list of pairs `(METRIC, ERROR)` for the metrics that could not be realized, which are realized again when their alerts are posted."""
+    try:
+        detector.realize()
+    except (EnvironmentError, httplib.HTTPException, ValueError) as e:
+        return [(metric, e) for metric in metrics]
+
+    def realize_metric(metric):
+        try:
+            metric.realize()
+        except (EnvironmentError, httplib.HTTPException, ValueError) as e:
+            return metric, e
+
+    pool = ThreadPool(max_in_flight)
+    try:
+        results = pool.map(realize_metric, metrics)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for result in results if result is not None]
+
+def post_alerts(detector, alerts, max_in_flight=MAX_CONNECTIONS, compact=False):
+    """Post each alert in `alerts`, a list of tuples `(METRIC, PAYLOAD, EMAILS, DATE)`, with at most `max_in_flight` requests at once. Alerts for the same metric are posted one after another, in the order given, and once one of them fails for any reason other than being rejected (see `is_rejection`) the rest aren't attempted. If `compact` is set, payloads are trimmed and rounded with `compact_payload`.
+
+Returns a tuple `(POSTED, DUPLICATES, FAILURES)`, where `POSTED` is a list of the alerts that were posted, `DUPLICATES` is a list of the alerts that had already been submitted, and `FAILURES` is a list of pairs `(ALERT, ERROR)` for the alerts that could not be posted. If the detector can't be realized, none of the alerts are attempted and its error is raised instead."""
+    detector.realize()
+    alerts_by_metric = collections.OrderedDict()
+    for alert in alerts:
+        alerts_by_metric.setdefault(alert[0].name, []).append(alert)
+
+    def post_metric_alerts(metric_alerts):
+        results = []
+        for i, alert in enumerate(metric_alerts):
+            metric, payload, emails, date = alert
+            try:
+                submit_alert(detector, metric, payload, emails, date, compact)
+                results.append((alert, None))
+            except (EnvironmentError, httplib.HTTPException, ValueError) as e:
+                if is_rejection(e): # the alert won't be posted later, so the later alerts can still be posted in order
+                    results.append((alert, e))
+                else: # the later alerts for the metric would be posted out of order when this one is retried, so they fail too
+                    results += [(later_alert, e) for later_alert in metric_alerts[i:]]
+                    break
+        return results
+
+    pool = ThreadPool(max_in_flight)
+    try:
+        results = pool.map(post_metric_alerts, alerts_by_metric.values())
+    finally:
+        pool.close()
+        pool.join()
+
+    posted, duplicates, failures = [], [], []
+    for alert, error in itertools.chain.from_iterable(results):
+        if error is None:
+            posted.append(alert)
+        elif isinstance(error, urllib2.HTTPError) and error.code == 422:
+            duplicates.append(alert)
+        else:
+            failures.append((alert, error))
+    return posted, duplicates, failures
+
 if __name__ == "__main__":
     set_server_url("http://localhost:8080")
     detector = Detector("Histogram Regression Detector", "foobar")